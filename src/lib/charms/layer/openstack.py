@@ -1,19 +1,33 @@
 import binascii
 import contextlib
+import hashlib
 import json
 import re
 import os
+import queue
+import random
+import ssl
 import subprocess
 import tempfile
+import threading
 from base64 import b64decode, b64encode
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from functools import lru_cache
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from functools import cached_property, lru_cache, partial
 from ipaddress import ip_address, ip_network
 from pathlib import Path
-from time import sleep
+from time import monotonic, sleep, time
 from traceback import format_exc
-from typing import Generator, Optional
-from urllib.request import urlopen
+from typing import Callable, Generator, Iterable, Optional
+from urllib.request import (
+    HTTPSHandler,
+    ProxyHandler,
+    build_opener,
+    proxy_bypass_environment,
+)
 from urllib.parse import urlparse
 from urllib.error import HTTPError
 
@@ -21,13 +35,47 @@ import charms.proxylib
 import yaml
 
 from charmhelpers.core import hookenv
-from charmhelpers.core.unitdata import kv
+from charmhelpers.core import unitdata
 
 from charms.layer import status
 
 
 CACHED_LB_PREFIX = "created_lbs"
 ENDPOINT_TIMEOUT = 30.0  # seconds
+TOKEN_CACHE_KEY = "charm.openstack.token"
+CATALOG_CACHE_KEY = "charm.openstack.catalog"
+SUBNET_INDEX_KEY = "charm.openstack.subnets"
+PORT_SECURITY_KEY = "charm.openstack.port-security"
+CREDS_FINGERPRINT_KEY = "charm.openstack.creds-fingerprint"
+API_VERSION_KEY = "charm.openstack.api-version"
+CREDS_SECRET_KEY = "charm.openstack.creds-secret"
+# config options which the credentials are taken from
+CREDS_CONFIG_KEYS = (
+    "credentials",
+    "auth-url",
+    "username",
+    "password",
+    "domain-id",
+    "domain-name",
+    "project-id",
+    "project-name",
+    "user-domain-name",
+    "user-domain-id",
+    "project-domain-name",
+    "project-domain-id",
+    "region",
+    "endpoint-tls-ca",
+)
+WAIT_INITIAL_INTERVAL = 0.5  # seconds
+WAIT_MAX_INTERVAL = 10.0  # seconds
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+# how the CLI and the native transport report that nothing matched a name or ID
+NOT_FOUND_RE = re.compile(
+    rb"No \w+ (found for|with a name or ID of)|Unable to find \w+ with name or id"
+    rb"|Unable to locate \S+ in \w+"
+)
+# how they report that a name matched more than one resource
+CONFLICT_RE = re.compile(rb"More than one \w+ exists")
 
 # When debugging hooks, for some reason HOME is set to /home/ubuntu, whereas
 # during normal hook execution, it's /root. Set it here to be consistent.
@@ -47,6 +95,89 @@ def log_err(msg, *args):
     hookenv.log(msg.format(*args), hookenv.ERROR)
 
 
+_main_thread_calls: "queue.Queue[tuple]" = queue.Queue()
+
+
+def kv():
+    """
+    Get the unitdata storage.
+
+    Its sqlite connection can only be used from the main thread, so calls
+    made from the workers of run_concurrently are handed over to the main
+    thread to run.
+    """
+    storage = unitdata.kv()
+    if threading.current_thread() is threading.main_thread():
+        return storage
+    return _OnMainThread(storage)
+
+
+class _OnMainThread:
+    """Proxy which runs method calls on the main thread."""
+
+    def __init__(self, wrapped):
+        self._wrapped = wrapped
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            future = Future()
+            _main_thread_calls.put((future, attr, args, kwargs))
+            return future.result()
+
+        return call
+
+
+def _run_main_thread_calls(timeout):
+    """Run a queued call from a worker thread, waiting up to timeout for one."""
+    try:
+        future, func, args, kwargs = _main_thread_calls.get(timeout=timeout)
+    except queue.Empty:
+        return
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+
+
+def run_concurrently(
+    func: Callable, items: Iterable, max_workers: int
+) -> Generator[tuple, None, None]:
+    """
+    Call func for each of the items using at most max_workers threads.
+
+    Yields (item, future) pairs in the order in which they complete, so the
+    caller can act on each result as soon as it's available.  This can be
+    nested within another run_concurrently, in which case the outermost one
+    runs the calls handed over to the main thread.
+    """
+    on_main_thread = threading.current_thread() is threading.main_thread()
+    executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+    pending = {executor.submit(func, item): item for item in items}
+    try:
+        while pending:
+            if on_main_thread:
+                _run_main_thread_calls(timeout=0.05)
+            else:
+                wait(pending, return_when=FIRST_COMPLETED)
+            for future in [f for f in pending if f.done()]:
+                yield pending.pop(future), future
+    finally:
+        # if the caller stops early, e.g. on an exception, the workers which
+        # already started may still be waiting on the main thread for calls
+        for future in pending:
+            future.cancel()
+        while not all(future.done() for future in pending):
+            if on_main_thread:
+                _run_main_thread_calls(timeout=0.05)
+            else:
+                wait(pending, timeout=0.05)
+        executor.shutdown(wait=True)
+
+
 def update_credentials():
     """
     Update the credentials from either the config or the hook tool.
@@ -75,23 +206,30 @@ def update_credentials():
     # pre-populate with empty values to avoid key and arg errors
     creds_data = {field: "" for field in required_fields + optional_fields}
 
+    trusted_creds = _credential_get()
+    # normalizing the creds can mean asking Keystone for its version, so
+    # it's only done when their source has changed or the TTL has expired
+    source_fingerprint = fingerprint(
+        {
+            "trust": trusted_creds,
+            "config": {key: config.get(key) for key in CREDS_CONFIG_KEYS},
+        }
+    )
+    cached = kv().get(CREDS_FINGERPRINT_KEY)
+    ttl = int(config.get("credentials-cache-ttl") or 0)
+    if (
+        isinstance(cached, dict)
+        and cached.get("fingerprint") == source_fingerprint
+        and time() < cached.get("checked_at", 0) + ttl
+        and _load_creds()
+    ):
+        log("Credentials unchanged")
+        return True
+
     try:
-        # try to use Juju's trust feature
-        try:
-            log("Checking credentials-get for credentials")
-            result = subprocess.run(
-                ["credential-get"],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            _creds_data = yaml.safe_load(result.stdout.decode("utf8"))
+        if trusted_creds is not None:
+            _creds_data = yaml.safe_load(trusted_creds)
             _merge_if_set(creds_data, _normalize_creds(_creds_data))
-        except FileNotFoundError:
-            pass  # juju trust not available
-        except subprocess.CalledProcessError as e:
-            if "permission denied" not in e.stderr.decode("utf8"):
-                raise
 
         # merge in combined credentials config
         if config["credentials"]:
@@ -125,6 +263,14 @@ def update_credentials():
 
     if all(creds_data[k] for k in required_fields):
         _save_creds(creds_data)
+        if creds_data.get("version"):
+            kv().set(
+                CREDS_FINGERPRINT_KEY,
+                {"fingerprint": source_fingerprint, "checked_at": time()},
+            )
+        else:
+            # the API version couldn't be discovered, so try again next hook
+            clear_creds_fingerprint()
         return True
     elif not any(creds_data[k] for k in required_fields):
         # no creds provided
@@ -141,10 +287,82 @@ def update_credentials():
         return False
 
 
+def clear_creds_fingerprint():
+    """Make the next update_credentials check the credentials again."""
+    kv().unset(CREDS_FINGERPRINT_KEY)
+
+
+def _credential_get() -> Optional[str]:
+    """
+    Get the credentials from Juju's trust feature, or None if the charm
+    hasn't been trusted.
+    """
+    try:
+        log("Checking credentials-get for credentials")
+        result = subprocess.run(
+            ["credential-get"],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        return result.stdout.decode("utf8")
+    except FileNotFoundError:
+        return None  # juju trust not available
+    except subprocess.CalledProcessError as e:
+        if "permission denied" not in e.stderr.decode("utf8"):
+            raise
+        return None
+
+
 def get_credentials():
     return _load_creds()
 
 
+def credentials_secret(relation_ids) -> str:
+    """
+    Get the ID of the Juju secret holding the credentials, granted to each
+    of the given relations.
+
+    The secret is owned by this unit, and only gets a new revision when the
+    credentials change, so that clients keep reading it by the same ID.
+    """
+    content = {
+        key.replace("_", "-"): str(value)
+        for key, value in get_credentials().items()
+        if value not in (None, "")
+    }
+    digest = fingerprint(content)
+    stored = kv().get(CREDS_SECRET_KEY) or {}
+    secret_id, granted = stored.get("id"), set(stored.get("granted", []))
+    if not secret_id or stored.get("digest") != digest:
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml") as content_file:
+            yaml.safe_dump(content, content_file)
+            content_file.flush()
+            if secret_id:
+                log("Updating credentials secret {}", secret_id)
+                _secret_tool("secret-set", secret_id, "--file", content_file.name)
+            else:
+                secret_id = _secret_tool(
+                    "secret-add", "--owner", "unit", "--file", content_file.name
+                )
+                log("Created credentials secret {}", secret_id)
+    for relation_id in relation_ids:
+        if relation_id not in granted:
+            _secret_tool("secret-grant", secret_id, "--relation", relation_id)
+    kv().set(
+        CREDS_SECRET_KEY,
+        {"id": secret_id, "digest": digest, "granted": sorted(relation_ids)},
+    )
+    return secret_id
+
+
+def _secret_tool(*args) -> str:
+    result = subprocess.run(
+        args, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    return result.stdout.decode("utf8").strip()
+
+
 def detect_octavia():
     """
     Determine whether the underlying OpenStack is using Octavia or not.
@@ -152,18 +370,83 @@ def detect_octavia():
     Returns True if Octavia is found in the region, and False otherwise.
     """
     try:
-        creds = _load_creds()
-        region = creds["region"]
-        for catalog in _openstack("catalog", "list"):
-            if catalog["Name"] == "octavia":
-                for endpoint in catalog.get("Endpoints", []):
-                    if endpoint["region"] == region:
-                        return True
+        catalog = get_catalog()
+        return catalog.has_service(name="octavia") or catalog.has_service(
+            service_type="load-balancer"
+        )
     except Exception:
         log_err("Error while trying to detect Octavia\n{}", format_exc())
         return False
 
-    return False
+
+class ServiceCatalog:
+    """
+    Index of the services and endpoints from the catalog which are
+    available in a single region.
+    """
+
+    def __init__(self, catalog, region):
+        self.region = region
+        self._by_name = {}
+        self._by_type = {}
+        for service in catalog:
+            endpoints = [
+                endpoint
+                for endpoint in service.get("Endpoints") or []
+                if region in (endpoint.get("region"), endpoint.get("region_id"))
+            ]
+            if not endpoints:
+                continue
+            self._by_name.setdefault(service.get("Name"), []).extend(endpoints)
+            self._by_type.setdefault(service.get("Type"), []).extend(endpoints)
+
+    def has_service(self, name=None, service_type=None) -> bool:
+        if name is not None:
+            return name in self._by_name
+        return service_type in self._by_type
+
+    def endpoint(self, service_type, interface="public") -> Optional[str]:
+        """Get the URL of the given service, if it's in the region."""
+        for endpoint in self._by_type.get(service_type, []):
+            if endpoint.get("interface") == interface:
+                return endpoint.get("url")
+        return None
+
+
+def get_catalog(refresh=False) -> ServiceCatalog:
+    """
+    Get the service catalog for the current creds.
+
+    The catalog is cached in unitdata, keyed on the auth URL and region, for
+    the number of seconds given by the catalog-cache-ttl config.
+    """
+    creds = _load_creds()
+    if refresh:
+        clear_catalog_cache()
+    return _cached_catalog(creds["auth_url"], creds["region"])
+
+
+def clear_catalog_cache():
+    kv().unset(CATALOG_CACHE_KEY)
+    _cached_catalog.cache_clear()
+    _read_cache.invalidate("catalog")
+
+
+@lru_cache(maxsize=1)
+def _cached_catalog(auth_url, region) -> ServiceCatalog:
+    ttl = int(hookenv.config().get("catalog-cache-ttl") or 0)
+    key = "{}|{}".format(auth_url, region)
+    cached = kv().get(CATALOG_CACHE_KEY)
+    if (
+        isinstance(cached, dict)
+        and cached.get("key") == key
+        and time() < cached.get("fetched_at", 0) + ttl
+    ):
+        return ServiceCatalog(cached["catalog"], region)
+
+    catalog = _openstack("catalog", "list")
+    kv().set(CATALOG_CACHE_KEY, {"key": key, "fetched_at": time(), "catalog": catalog})
+    return ServiceCatalog(catalog, region)
 
 
 def _get_relation_addresses(endpoint_name):
@@ -193,52 +476,242 @@ def _get_relation_addresses(endpoint_name):
 
 
 def _default_subnet(members, endpoint_name):
-    """Find the subnet which contains the given address."""
+    """
+    Find the subnet which contains the given members, or the addresses of
+    the relation if there are no members.
+
+    If the members are spread over several subnets, the one containing the
+    most of them is used.
+    """
     if members:
-        address, _ = members[0]
-    elif addresses := _get_relation_addresses(endpoint_name):
-        address = addresses[0]
-    else:
+        addresses = [address for address, _ in members]
+    elif not (addresses := _get_relation_addresses(endpoint_name)):
         log_err("Unable to find addresses for relation: {}", endpoint_name)
         raise OpenStackLBError(action="create", exc=False)
-    address = ip_address(address)
-    for subnet_info in _openstack("subnet", "list"):
-        subnet = ip_network(subnet_info["Subnet"])
-        if address in subnet:
-            return subnet_info["Name"]
-    else:
-        log_err("Unable to find subnet for {}", address)
+    subnets = resolve_subnets(addresses)
+    counts = Counter(subnet for subnet in subnets.values() if subnet)
+    if not counts:
+        log_err("Unable to find subnet for {}", addresses[0])
         raise OpenStackLBError(action="create", exc=False)
+    if missing := [address for address, subnet in subnets.items() if not subnet]:
+        log("Unable to find subnet for {}", ", ".join(missing))
+    if len(counts) > 1:
+        hookenv.log(
+            "Addresses span several subnets ({}), using the most common".format(
+                ", ".join(counts)
+            ),
+            hookenv.WARNING,
+        )
+    return counts.most_common(1)[0][0]
+
+
+def resolve_subnets(addresses) -> dict:
+    """
+    Find the most specific subnet containing each of the given addresses.
+
+    Returns a dict of each address to the name of its subnet, or None if
+    it's not in any subnet, even once the index has been refreshed.
+    """
+    index = get_subnet_index()
+    subnets = {address: index.lookup(address) for address in addresses}
+    if None in subnets.values() and not index.fresh:
+        # the subnet may have been created since the index was cached
+        index = get_subnet_index(refresh=True)
+        subnets = {address: index.lookup(address) for address in addresses}
+    return subnets
+
+
+class SubnetIndex:
+    """
+    Index of the subnets of the project, for finding the most specific
+    subnet which contains an address.
+
+    Subnets are grouped by IP version and prefix length, so a lookup only
+    needs to mask the address once for each prefix length in use.
+    """
+
+    def __init__(self, subnets, fresh=False):
+        # whether the subnets were listed during this hook
+        self.fresh = fresh
+        self._by_prefix = {}
+        for subnet in subnets:
+            network = ip_network(subnet["Subnet"], strict=False)
+            prefix = (network.version, network.prefixlen)
+            networks = self._by_prefix.setdefault(prefix, {})
+            networks[int(network.network_address)] = subnet["Name"]
+        # longest prefixes first
+        self._prefixes = sorted(self._by_prefix, key=lambda p: p[1], reverse=True)
+
+    def lookup(self, address) -> Optional[str]:
+        """Get the name of the most specific subnet containing the address."""
+        address = ip_address(address)
+        for version, prefixlen in self._prefixes:
+            if version != address.version:
+                continue
+            host_bits = address.max_prefixlen - prefixlen
+            network = int(address) >> host_bits << host_bits
+            if name := self._by_prefix[version, prefixlen].get(network):
+                return name
+        return None
+
+
+def get_subnet_index(refresh=False) -> SubnetIndex:
+    """
+    Get the subnet index for the current creds.
+
+    The subnets are cached in unitdata, keyed on the auth URL and region,
+    for the number of seconds given by the subnet-cache-ttl config.
+    """
+    creds = _load_creds()
+    if refresh:
+        clear_subnet_index()
+    return _cached_subnet_index(creds["auth_url"], creds["region"])
+
+
+def clear_subnet_index():
+    kv().unset(SUBNET_INDEX_KEY)
+    _cached_subnet_index.cache_clear()
+    _read_cache.invalidate("subnet")
+
+
+def port_security_enabled(subnet) -> bool:
+    """
+    Whether port security is enabled on the network of the given subnet.
+
+    The network of each subnet, and whether each network has port security,
+    are cached in unitdata for the number of seconds given by the
+    port-security-cache-ttl config.
+    """
+    ttl = int(hookenv.config().get("port-security-cache-ttl") or 0)
+
+    def _cached(key):
+        cached = kv().get(key)
+        if isinstance(cached, dict) and time() < cached.get("fetched_at", 0) + ttl:
+            return cached
+        return None
+
+    subnet_key = "{}.subnet.{}".format(PORT_SECURITY_KEY, subnet)
+    if cached := _cached(subnet_key):
+        network_id = cached["network_id"]
+    else:
+        network_id = _openstack("subnet", "show", subnet)["network_id"]
+        kv().set(subnet_key, {"fetched_at": time(), "network_id": network_id})
+
+    network_key = "{}.network.{}".format(PORT_SECURITY_KEY, network_id)
+    if cached := _cached(network_key):
+        return cached["enabled"]
+    enabled = _openstack("network", "show", network_id)["port_security_enabled"]
+    kv().set(network_key, {"fetched_at": time(), "enabled": enabled})
+    return enabled
+
+
+def clear_port_security_cache():
+    kv().unsetrange(prefix=PORT_SECURITY_KEY + ".")
+
+
+@lru_cache(maxsize=1)
+def _cached_subnet_index(auth_url, region) -> SubnetIndex:
+    ttl = int(hookenv.config().get("subnet-cache-ttl") or 0)
+    key = "{}|{}".format(auth_url, region)
+    cached = kv().get(SUBNET_INDEX_KEY)
+    if (
+        isinstance(cached, dict)
+        and cached.get("key") == key
+        and time() < cached.get("fetched_at", 0) + ttl
+    ):
+        return SubnetIndex(cached["subnets"])
+
+    subnets = [
+        {"Name": subnet["Name"], "Subnet": subnet["Subnet"]}
+        for subnet in _openstack("subnet", "list")
+    ]
+    kv().set(SUBNET_INDEX_KEY, {"key": key, "fetched_at": time(), "subnets": subnets})
+    return SubnetIndex(subnets, fresh=True)
 
 
 def manage_loadbalancer(
-    app_name, members, lb_port, lb_algorithm, endpoint_name="lb-consumers"
+    app_name,
+    members,
+    lb_port,
+    lb_algorithm,
+    endpoint_name="lb-consumers",
+    refresh=False,
 ):
+    """
+    Create or update the LB for the given app.
+
+    If refresh is set, the cached state of an existing LB is checked
+    against the cloud first, so that changes made out of band are undone.
+    """
     log("Managing load balancer for {}", app_name)
     config = hookenv.config()
     subnet = config["lb-subnet"] or _default_subnet(members, endpoint_name)
     fip_net = config["lb-floating-network"]
     manage_secgrps = config["manage-security-groups"]
+    members = [(addr, str(port)) for addr, port in members]
     lb_manager = LoadBalancer.get_or_create(
-        app_name, str(lb_port), subnet, lb_algorithm, fip_net, manage_secgrps
+        app_name,
+        str(lb_port),
+        subnet,
+        lb_algorithm,
+        fip_net,
+        manage_secgrps,
+        members,
+        refresh,
     )
-    lb_manager.update_members([(addr, str(port)) for addr, port in members])
+    lb_manager.update_members(members)
+    lb_manager.inputs_hash = _lb_inputs_hash(members, lb_port, lb_algorithm)
+    lb_manager._update_cached_info()
     return lb_manager
 
 
+def get_unchanged_loadbalancer(app_name, members, lb_port, lb_algorithm):
+    """
+    Get the cached info of the LB for the given app if it was last managed
+    with the same members, port, algorithm and LB config, or None if it
+    needs to be managed again.
+    """
+    info = kv().get("{}.{}".format(CACHED_LB_PREFIX, _lb_name(app_name)))
+    if info and info.get("inputs_hash") == _lb_inputs_hash(
+        members, lb_port, lb_algorithm
+    ):
+        return info
+    return None
+
+
+def _lb_name(app_name) -> str:
+    return "openstack-integrator-{}-{}".format(MODEL_SHORT_ID, app_name)
+
+
+def _lb_inputs_hash(members, lb_port, lb_algorithm) -> str:
+    config = hookenv.config()
+    return fingerprint(
+        {
+            "members": sorted([addr, str(port)] for addr, port in members),
+            "port": str(lb_port),
+            "algorithm": lb_algorithm,
+            "subnet": config["lb-subnet"],
+            "fip_net": config["lb-floating-network"],
+            "manage_secgrps": config["manage-security-groups"],
+        }
+    )
+
+
 class OpenStackError(Exception):
     pass
 
 
 class OpenStackLBError(OpenStackError):
-    def __init__(self, action, exc=True):
+    def __init__(self, action, exc=True, members=None):
         action = (action[:-1] if action.endswith("e") else action) + "ing"
         if exc:
             log_err("Error {} loadbalancer\n{}", action, format_exc())
-        super().__init__(
-            "Error while {} load balancer; "
-            "check credential and debug-log".format(action)
-        )
+        msg = "Error while {} load balancer; check credential and debug-log"
+        if members:
+            msg += "; failed members: " + ", ".join(
+                "{}:{}".format(*member) for member in sorted(members)
+            )
+        super().__init__(msg.format(action))
 
 
 # Internal helpers
@@ -309,6 +782,10 @@ def _normalize_creds(creds_data):
 
 
 def _save_creds(creds_data):
+    if creds_data != _load_creds():
+        # any cached token was issued for the old creds
+        kv().unset(TOKEN_CACHE_KEY)
+        clear_read_cache()
     kv().set("charm.openstack.full-creds", creds_data)
 
 
@@ -337,6 +814,45 @@ def cached_openstack_proxied() -> dict[str, str]:
         return {**proxied}
 
 
+def _proxies() -> dict[str, str]:
+    """
+    Get the proxy settings for reaching the OpenStack API, in the form
+    requests takes them.
+
+    These are passed explicitly to the API calls rather than set in the
+    environment, which is shared by the threads of run_concurrently.
+    """
+    settings = cached_openstack_proxied()
+    proxies = {}
+    for key, name in (("http", "http"), ("https", "https"), ("no_proxy", "no")):
+        value = settings.get(f"{name}_proxy") or settings.get(f"{name.upper()}_PROXY")
+        if value:
+            proxies[key] = value
+    return proxies
+
+
+def _proxied_session():
+    """
+    Get a requests session which uses the proxy settings.
+
+    Requests ignores no_proxy when it's set on the session, so whether to
+    bypass the proxy is decided for each request instead.
+    """
+    import requests
+    from requests.utils import should_bypass_proxies
+
+    proxies = _proxies()
+    no_proxy = proxies.pop("no_proxy", "")
+
+    class ProxiedSession(requests.Session):
+        def request(self, method, url, *args, **kwargs):
+            if proxies and not should_bypass_proxies(url, no_proxy):
+                kwargs.setdefault("proxies", proxies)
+            return super().request(method, url, *args, **kwargs)
+
+    return ProxiedSession()
+
+
 @contextmanager
 def openstack_proxied(env: Env) -> Generator[Env, None, None]:
     """
@@ -360,7 +876,18 @@ def openstack_proxied(env: Env) -> Generator[Env, None, None]:
         yield {**env}
 
 
-def _run_with_creds(*args):
+def _write_ca_cert(creds) -> Optional[str]:
+    """Write the endpoint CA to disk, returning its path if there is one."""
+    if creds["endpoint_tls_ca"]:
+        ca_cert = b64decode(creds["endpoint_tls_ca"].encode("utf8"))
+        CA_CERT_FILE.parent.mkdir(parents=True, exist_ok=True)
+        CA_CERT_FILE.write_text(ca_cert.decode("utf8") + "\n")
+    if CA_CERT_FILE.exists():
+        return str(CA_CERT_FILE)
+    return None
+
+
+def _run_with_creds(*args, token=None):
     creds = _load_creds()
     env = {
         "PATH": os.pathsep.join(["/snap/bin", os.environ["PATH"]]),
@@ -386,36 +913,841 @@ def _run_with_creds(*args):
             # keys should always be added by _normalize_creds, but its value
             # might be empty in which case we shouldn't set the env vars
             env[v] = found
-    if creds["endpoint_tls_ca"]:
-        ca_cert = b64decode(creds["endpoint_tls_ca"].encode("utf8"))
-        CA_CERT_FILE.parent.mkdir(parents=True, exist_ok=True)
-        CA_CERT_FILE.write_text(ca_cert.decode("utf8") + "\n")
-    if CA_CERT_FILE.exists():
-        env["OS_CACERT"] = str(CA_CERT_FILE)
+    if token:
+        # authenticate with the already issued token rather than the password;
+        # the client still exchanges it for a new scoped token on every call,
+        # since a single token endpoint can't serve all of the services
+        for key in ("OS_USERNAME", "OS_PASSWORD", "OS_USER_DOMAIN_NAME"):
+            del env[key]
+        env.pop("OS_USER_DOMAIN_ID", None)
+        env["OS_AUTH_TYPE"] = "v3token"
+        env["OS_TOKEN"] = token
+    if ca_file := _write_ca_cert(creds):
+        env["OS_CACERT"] = ca_file
 
     with openstack_proxied(env) as proxy_env:
-        result = subprocess.run(
-            args,
-            env=proxy_env,
-            check=True,
-            stdout=subprocess.PIPE,
-            timeout=ENDPOINT_TIMEOUT,
-        )
+        try:
+            result = subprocess.run(
+                args,
+                env=proxy_env,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=ENDPOINT_TIMEOUT,
+            )
+        except subprocess.CalledProcessError as e:
+            # the error is kept on the exception, but should still be logged
+            log("{}", (e.stderr or b"").decode("utf8").strip())
+            raise
     return result.stdout.decode("utf8")
 
 
+def _is_not_found(e: subprocess.CalledProcessError) -> bool:
+    """Whether a command failed only because nothing matched the name or ID."""
+    return bool(e.stderr and NOT_FOUND_RE.search(e.stderr))
+
+
+def _is_conflict(e: subprocess.CalledProcessError) -> bool:
+    """Whether the command failed because a name matched many resources."""
+    return bool(e.stderr and CONFLICT_RE.search(e.stderr))
+
+
 def _openstack(*args, yaml_output=True):
-    if yaml_output:
-        output = _run_with_creds("openstack", *args, "--format=yaml")
+    return _read_cache.run("openstack", args, yaml_output)
+
+
+def _neutron(*args):
+    return _read_cache.run("neutron", args)
+
+
+class _ReadCache:
+    """
+    Cache of the results of read-only commands for the rest of the hook.
+
+    Results are keyed on the command's argv and dropped whenever a command
+    changes a resource of the same type.  LB resources change by themselves
+    as they're provisioned, so reads of those are never cached.
+    """
+
+    READ_VERBS = ("list", "show")
+    WRITE_VERBS = ("create", "delete", "set", "unset", "add", "remove")
+    UNCACHED_RESOURCES = ("loadbalancer", "lbaas")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}
+        self.hits = 0
+        self.misses = 0
+        self._log_at_exit = True
+
+    @classmethod
+    def _parse(cls, cli, args):
+        """
+        Split a command into the type of resource it acts on and its verb,
+        eg. ("security group rule", "list").
+        """
+        words = list(args)
+        if cli == "neutron" and words:
+            # eg. lbaas-pool-show
+            words[:1] = words[0].split("-")
+        for i, word in enumerate(words):
+            if word in cls.READ_VERBS + cls.WRITE_VERBS:
+                return " ".join(words[:i]), word
+            if word.startswith("-"):
+                break
+        return None, None
+
+    def run(self, cli, args, yaml_output=True):
+        """
+        Run the command through the current transport, or return its cached
+        result.
+        """
+        args = tuple(str(arg) for arg in args)
+        resource, verb = self._parse(cli, args)
+        if verb not in self.READ_VERBS or resource.startswith(self.UNCACHED_RESOURCES):
+            try:
+                return _get_transport().run(cli, args, yaml_output)
+            finally:
+                # even a failed change may have been partly made
+                if verb not in self.READ_VERBS:
+                    self.invalidate(resource)
+        key = (cli, args, yaml_output)
+        with self._lock:
+            if self._log_at_exit:
+                hookenv.atexit(self._log_stats)
+                self._log_at_exit = False
+            if key in self._results:
+                self.hits += 1
+                return deepcopy(self._results[key])
+        result = _get_transport().run(cli, args, yaml_output)
+        with self._lock:
+            self.misses += 1
+            self._results[key] = result
+        return deepcopy(result)
+
+    def _log_stats(self):
+        log("Read cache: {} hits, {} misses", self.hits, self.misses)
+
+    def invalidate(self, resource=None):
+        """
+        Drop the results for the given type of resource, including types
+        nested within it, or all results if no type is given.
+        """
+        with self._lock:
+            for key in list(self._results):
+                if resource is None or self._parse(*key[:2])[0].startswith(resource):
+                    del self._results[key]
+
+
+_read_cache = _ReadCache()
+
+
+def read_cache_stats():
+    """
+    Return the number of hits and misses of the read cache in this hook.
+    """
+    return {"hits": _read_cache.hits, "misses": _read_cache.misses}
+
+
+def clear_read_cache():
+    _read_cache.invalidate()
+
+
+def fingerprint(data) -> str:
+    """Get a stable hash of JSON serializable data."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def _keystone_auth(creds):
+    """
+    Create a keystoneauth password plugin for the given creds.
+
+    If unitdata holds a token for these creds which isn't about to expire,
+    the plugin is primed with it so that no new token needs to be issued.
+    """
+    from keystoneauth1.identity import generic
+
+    auth_args = dict(
+        auth_url=creds["auth_url"],
+        username=creds["username"],
+        password=creds["password"],
+        user_domain_name=creds.get("user_domain_name") or None,
+        user_domain_id=creds.get("user_domain_id") or None,
+    )
+    if creds.get("project_id") or creds.get("project_name"):
+        auth_args.update(
+            project_id=creds.get("project_id") or None,
+            project_name=creds.get("project_name") or None,
+            project_domain_name=creds.get("project_domain_name") or None,
+            project_domain_id=creds.get("project_domain_id") or None,
+        )
     else:
-        output = _run_with_creds("openstack", *args)
+        auth_args.update(
+            domain_id=creds.get("domain_id") or None,
+            domain_name=creds.get("domain_name") or None,
+        )
+    auth = generic.Password(**auth_args)
+    if cached := _load_token(creds):
+        auth.set_auth_state(cached["auth_state"])
+    return auth
+
+
+def _load_token(creds) -> Optional[dict]:
+    """Get the cached token for creds, if it's still usable."""
+    cached = kv().get(TOKEN_CACHE_KEY)
+    if not isinstance(cached, dict):
+        return None
+    if cached.get("creds") != fingerprint(creds):
+        return None
+    expires_at = datetime.fromisoformat(cached["expires_at"])
+    if expires_at - TOKEN_EXPIRY_MARGIN <= datetime.now(timezone.utc):
+        return None
+    return cached
+
+
+def _save_token(creds, auth):
+    """Cache the token, its expiry and catalog held by the auth plugin."""
+    access = auth.auth_ref
+    kv().set(
+        TOKEN_CACHE_KEY,
+        {
+            "creds": fingerprint(creds),
+            "token": access.auth_token,
+            "expires_at": access.expires.isoformat(),
+            "auth_state": auth.get_auth_state(),
+        },
+    )
+    log("Cached keystone token valid until {}", access.expires.isoformat())
 
-    return yaml.safe_load(output)
 
+def _keystone_token(creds) -> Optional[str]:
+    """
+    Get a scoped keystone token for creds, issuing and caching a new one if
+    there isn't a usable one in unitdata.
+
+    Returns None if a token can't be had, in which case the caller should
+    authenticate with the password.
+    """
+    if not str(creds.get("version") or "3").startswith("3"):
+        return None
+    if cached := _load_token(creds):
+        return cached["token"]
+    try:
+        from keystoneauth1 import session
+
+        auth = _keystone_auth(creds)
+        verify = _write_ca_cert(creds) or True
+        auth.get_access(
+            session.Session(auth=auth, verify=verify, session=_proxied_session())
+        )
+    except ImportError:
+        return None
+    except Exception:
+        log_err("Unable to issue keystone token\n{}", format_exc())
+        return None
+    _save_token(creds, auth)
+    return auth.auth_ref.auth_token
+
+
+def _project_id() -> Optional[str]:
+    """
+    Get the ID of the project the credentials are scoped to, from the
+    credentials or else the cached keystone token, or None if it isn't known.
+    """
+    creds = _load_creds()
+    if creds.get("project_id"):
+        return creds["project_id"]
+    _keystone_token(creds)
+    if cached := _load_token(creds):
+        try:
+            body = json.loads(cached["auth_state"])["body"]
+            return body["token"]["project"]["id"]
+        except (KeyError, TypeError, ValueError):
+            pass
+    return None
 
-def _neutron(*args):
-    output = _run_with_creds("neutron", *args, "--format=yaml")
-    return yaml.safe_load(output)
+
+class UnsupportedCommand(Exception):
+    """Raised when a transport doesn't know how to service a command."""
+
+
+class CLITransport:
+    """
+    Transport which runs each command through the openstackclients snap.
+    """
+
+    name = "cli"
+
+    def run(self, cli, args, yaml_output=True):
+        if yaml_output:
+            args = (*args, "--format=yaml")
+        token = _keystone_token(_load_creds()) if cli == "openstack" else None
+        return yaml.safe_load(_run_with_creds(cli, *args, token=token))
+
+
+def _parse_cli_args(args, flags=("ingress", "cascade", "long")):
+    """
+    Split CLI style arguments into positional values and an options dict.
+
+    Options are keyed by their name without leading dashes; the ones named
+    in flags take no value.
+    """
+    positional, opts = [], {}
+    args = iter(args)
+    for arg in args:
+        if not arg.startswith("-"):
+            positional.append(arg)
+            continue
+        key, sep, value = arg.lstrip("-").partition("=")
+        if not sep:
+            value = True if key in flags else next(args)
+        opts[key] = value
+    return positional, opts
+
+
+class NativeTransport:
+    """
+    Transport which services commands in-process over one authenticated
+    keystoneauth session, so the token and the HTTP connections are reused
+    for every call in the hook rather than paying for a new interpreter and
+    a new Keystone token per command.
+
+    The commands are the same argv the CLI would be given, and the results
+    have the same shape as the CLI's YAML output.  Commands which aren't
+    implemented here are handed to the CLI transport.
+    """
+
+    name = "native"
+
+    OCTAVIA = ("load-balancer", "/v2/lbaas")
+    NEUTRON_LBAAS = ("network", "/v2.0/lbaas")
+    UUID_RE = re.compile(r"^[0-9a-f]{8}(-?[0-9a-f]{4}){3}-?[0-9a-f]{12}$", re.I)
+
+    def __init__(self, creds, fallback=None):
+        self.creds = creds
+        self.region = creds["region"]
+        self.fallback = fallback or CLITransport()
+        self.session = self._create_session()
+        self._auth_ref = self.session.auth.auth_ref
+        self._commands = {
+            ("openstack", "catalog", "list"): self._catalog_list,
+            ("openstack", "subnet", "list"): self._subnet_list,
+            ("openstack", "subnet", "show"): self._subnet_show,
+            ("openstack", "network", "show"): self._network_show,
+            ("openstack", "security", "group", "list"): self._secgrp_list,
+            ("openstack", "security", "group", "show"): self._secgrp_show,
+            ("openstack", "security", "group", "create"): self._secgrp_create,
+            ("openstack", "security", "group", "delete"): self._secgrp_delete,
+            ("openstack", "security", "group", "rule", "list"): self._rule_list,
+            ("openstack", "security", "group", "rule", "create"): self._rule_create,
+            ("openstack", "port", "list"): self._port_list,
+            ("openstack", "port", "show"): self._port_show,
+            ("openstack", "port", "set"): self._port_set,
+            ("openstack", "floating", "ip", "list"): self._fip_list,
+            ("openstack", "floating", "ip", "create"): self._fip_create,
+            ("openstack", "floating", "ip", "delete"): self._fip_delete,
+            **self._lbaas_commands(self.OCTAVIA, self._octavia_command),
+            **self._lbaas_commands(
+                self.NEUTRON_LBAAS, self._neutron_command, member_first=True
+            ),
+        }
+
+    @staticmethod
+    def _octavia_command(resource, op):
+        if resource == "loadbalancer":
+            return ("openstack", "loadbalancer", op)
+        return ("openstack", "loadbalancer", resource, op)
+
+    @staticmethod
+    def _neutron_command(resource, op):
+        return ("neutron", f"lbaas-{resource}-{op}")
+
+    def _lbaas_commands(self, api, command, member_first=False):
+        commands = {}
+        for resource in ("loadbalancer", "listener", "pool", "healthmonitor"):
+            commands[command(resource, "list")] = partial(
+                self._lbaas_list, api, resource
+            )
+            commands[command(resource, "show")] = partial(
+                self._lbaas_show, api, resource
+            )
+            commands[command(resource, "create")] = partial(
+                self._lbaas_create, api, resource
+            )
+            commands[command(resource, "delete")] = partial(
+                self._lbaas_delete, api, resource
+            )
+        commands[command("member", "list")] = partial(self._member_list, api)
+        commands[command("member", "create")] = partial(self._member_create, api)
+        commands[command("member", "delete")] = partial(
+            self._member_delete, api, member_first
+        )
+        return commands
+
+    def _create_session(self):
+        from keystoneauth1 import session
+
+        auth = _keystone_auth(self.creds)
+        verify = _write_ca_cert(self.creds) or True
+        return session.Session(
+            auth=auth,
+            verify=verify,
+            timeout=ENDPOINT_TIMEOUT,
+            session=_proxied_session(),
+        )
+
+    def _save_token(self):
+        """Persist the session's token whenever it has been (re)issued."""
+        auth = self.session.auth
+        if auth.auth_ref is not None and auth.auth_ref is not self._auth_ref:
+            self._auth_ref = auth.auth_ref
+            _save_token(self.creds, auth)
+
+    def run(self, cli, args, yaml_output=True):
+        for size in range(min(len(args), 4), 0, -1):
+            handler = self._commands.get((cli, *args[:size]))
+            if handler:
+                break
+        else:
+            return self.fallback.run(cli, args, yaml_output)
+
+        positional, opts = _parse_cli_args(args[size:])
+        try:
+            with self._api_call((cli, *args)):
+                result = handler(positional, opts)
+        except UnsupportedCommand as e:
+            log("Using the {} CLI for {}: {}", cli, " ".join(args[:size]), e)
+            return self.fallback.run(cli, args, yaml_output)
+        return self._select_columns(result, opts, yaml_output)
+
+    def replace_members(self, pool, members, subnet):
+        """
+        Replace all members of an Octavia pool with a single batch update.
+        """
+        with self._api_call(("batch member update", pool)):
+            subnet_id = self._subnet(subnet)["id"]
+            body = {
+                "members": [
+                    {
+                        "name": addr,
+                        "address": addr,
+                        "protocol_port": int(port),
+                        "subnet_id": subnet_id,
+                    }
+                    for addr, port in sorted(members)
+                ]
+            }
+            self._put("load-balancer", self._members_path(self.OCTAVIA, pool), body)
+
+    def create_loadbalancer_graph(self, loadbalancer, subnet):
+        """
+        Create an Octavia load balancer along with the listeners, pools,
+        members and health monitors nested within it, in a single request.
+
+        The VIP and the members are placed on the given subnet.
+        """
+        with self._api_call(("create populated loadbalancer", loadbalancer["name"])):
+            subnet_id = self._subnet(subnet)["id"]
+            body = deepcopy(loadbalancer)
+            body["vip_subnet_id"] = subnet_id
+            for listener in body.get("listeners", []):
+                for member in listener.get("default_pool", {}).get("members", []):
+                    member["subnet_id"] = subnet_id
+            service_type, base = self.OCTAVIA
+            resp = self._post(
+                service_type, f"{base}/loadbalancers", {"loadbalancer": body}
+            )
+            return resp["loadbalancer"]
+
+    @contextmanager
+    def _api_call(self, cmd):
+        """
+        Make API calls, saving any new token and raising failures the same
+        way as the CLI.
+        """
+        from keystoneauth1 import exceptions
+
+        try:
+            yield
+            self._save_token()
+        except exceptions.ClientException as e:
+            # callers already handle failures of the CLI
+            err = subprocess.CalledProcessError(1, cmd)
+            err.stderr = str(e).encode("utf8")
+            raise err from e
+
+    @staticmethod
+    def _select_columns(result, opts, yaml_output):
+        """Apply the -c / -f options the same way the CLI would."""
+        column = opts.get("c")
+        if not column:
+            return result
+        if isinstance(result, list):
+            return [{column: item.get(column)} for item in result]
+        if not yaml_output and opts.get("f") == "value":
+            return result.get(column)
+        return {column: result.get(column)}
+
+    # HTTP helpers
+
+    def _request(self, method, service_type, path, **kwargs):
+        endpoint_filter = {
+            "service_type": service_type,
+            "interface": "public",
+            "region_name": self.region,
+        }
+        resp = self.session.request(
+            path, method, endpoint_filter=endpoint_filter, **kwargs
+        )
+        if resp.status_code == 204 or not resp.content:
+            return None
+        return resp.json()
+
+    def _get(self, service_type, path, params=None):
+        return self._request("GET", service_type, path, params=params)
+
+    def _post(self, service_type, path, body):
+        return self._request("POST", service_type, path, json=body)
+
+    def _put(self, service_type, path, body):
+        return self._request("PUT", service_type, path, json=body)
+
+    def _delete(self, service_type, path, params=None):
+        return self._request("DELETE", service_type, path, params=params)
+
+    def _find(self, service_type, path, collection, name_or_id, **filters):
+        """
+        Resolve a name or ID to a single resource, like the CLI does.
+        """
+        from keystoneauth1 import exceptions
+
+        singular = collection[:-1]
+        if self.UUID_RE.match(name_or_id):
+            try:
+                return self._get(service_type, f"{path}/{name_or_id}")[singular]
+            except exceptions.NotFound:
+                pass
+        params = dict(filters, name=name_or_id)
+        found = self._get(service_type, path, params=params)[collection]
+        if len(found) > 1:
+            raise exceptions.Conflict(
+                f"More than one {singular} exists with the name '{name_or_id}'"
+            )
+        if not found:
+            raise exceptions.NotFound(
+                message=f"No {singular} with a name or ID of '{name_or_id}' exists"
+            )
+        return found[0]
+
+    # Identity
+
+    def _catalog_list(self, positional, opts):
+        access = self.session.auth.get_access(self.session)
+        return [
+            {
+                "Name": service.get("name"),
+                "Type": service.get("type"),
+                "Endpoints": service.get("endpoints", []),
+            }
+            for service in access.service_catalog.catalog
+        ]
+
+    # Network
+
+    def _subnet(self, name_or_id):
+        return self._find("network", "/v2.0/subnets", "subnets", name_or_id)
+
+    def _subnet_list(self, positional, opts):
+        return [
+            {
+                "ID": subnet["id"],
+                "Name": subnet["name"],
+                "Network": subnet["network_id"],
+                "Subnet": subnet["cidr"],
+            }
+            for subnet in self._get("network", "/v2.0/subnets")["subnets"]
+        ]
+
+    def _subnet_show(self, positional, opts):
+        return self._subnet(positional[0])
+
+    def _network_show(self, positional, opts):
+        return self._find("network", "/v2.0/networks", "networks", positional[0])
+
+    def _secgrp(self, name_or_id):
+        # admin credentials also see the groups of other projects
+        return self._find(
+            "network",
+            "/v2.0/security-groups",
+            "security_groups",
+            name_or_id,
+            project_id=self.session.get_project_id(),
+        )
+
+    def _secgrp_list(self, positional, opts):
+        params = {"project_id": opts["project"]} if opts.get("project") else {}
+        found = self._get("network", "/v2.0/security-groups", params=params)
+        return [
+            {
+                "ID": sg["id"],
+                "Name": sg["name"],
+                "Description": sg.get("description", ""),
+                "Project": sg.get("project_id") or sg.get("tenant_id"),
+                "Tags": sg.get("tags", []),
+            }
+            for sg in found["security_groups"]
+        ]
+
+    def _secgrp_show(self, positional, opts):
+        return self._secgrp(positional[0])
+
+    def _secgrp_create(self, positional, opts):
+        name = positional[0]
+        body = {"security_group": {"name": name, "description": name}}
+        return self._post("network", "/v2.0/security-groups", body)["security_group"]
+
+    def _secgrp_delete(self, positional, opts):
+        for name_or_id in positional:
+            sg = self._secgrp(name_or_id)
+            self._delete("network", f"/v2.0/security-groups/{sg['id']}")
+
+    def _rule_list(self, positional, opts):
+        params = {}
+        if positional:
+            params["security_group_id"] = self._secgrp(positional[0])["id"]
+        if opts.get("ingress"):
+            params["direction"] = "ingress"
+        if opts.get("protocol"):
+            params["protocol"] = opts["protocol"]
+        rules = self._get("network", "/v2.0/security-group-rules", params=params)
+        return [
+            {
+                "ID": rule["id"],
+                "IP Protocol": rule["protocol"],
+                "Ethertype": rule["ethertype"],
+                "IP Range": rule["remote_ip_prefix"],
+                "Port Range": (
+                    "{}:{}".format(rule["port_range_min"], rule["port_range_max"])
+                    if rule["port_range_min"] or rule["port_range_max"]
+                    else ""
+                ),
+                "Direction": rule["direction"],
+                "Remote Security Group": rule["remote_group_id"],
+            }
+            for rule in rules["security_group_rules"]
+        ]
+
+    def _rule_create(self, positional, opts):
+        port_min, _, port_max = str(opts["dst-port"]).partition(":")
+        rule = {
+            "security_group_id": self._secgrp(positional[0])["id"],
+            "direction": "ingress" if opts.get("ingress") else "egress",
+            "protocol": opts.get("protocol"),
+            "port_range_min": int(port_min),
+            "port_range_max": int(port_max or port_min),
+            "ethertype": "IPv4",
+        }
+        if remote_ip := opts.get("remote-ip"):
+            rule["remote_ip_prefix"] = remote_ip
+            rule["ethertype"] = "IPv{}".format(
+                ip_network(remote_ip, strict=False).version
+            )
+        body = {"security_group_rule": rule}
+        resp = self._post("network", "/v2.0/security-group-rules", body)
+        return resp["security_group_rule"]
+
+    def _port_list(self, positional, opts):
+        params = {}
+        if fixed_ip := opts.get("fixed-ip"):
+            fixed_ips = []
+            for field in fixed_ip.split(","):
+                key, _, value = field.partition("=")
+                if key == "subnet":
+                    fixed_ips.append("subnet_id=" + self._subnet(value)["id"])
+                else:
+                    fixed_ips.append(f"{key}={value}")
+            params["fixed_ips"] = fixed_ips
+        ports = []
+        for port in self._get("network", "/v2.0/ports", params=params)["ports"]:
+            item = {
+                "ID": port["id"],
+                "Name": port["name"],
+                "MAC Address": port["mac_address"],
+                "Fixed IP Addresses": port["fixed_ips"],
+                "Status": port["status"],
+            }
+            if opts.get("long"):
+                item["Security Groups"] = port["security_groups"]
+                item["Device Owner"] = port["device_owner"]
+            ports.append(item)
+        return ports
+
+    def _port(self, port_id):
+        return self._get("network", f"/v2.0/ports/{port_id}")["port"]
+
+    def _port_show(self, positional, opts):
+        port = self._port(positional[0])
+        return dict(port, security_group_ids=port["security_groups"])
+
+    def _port_set(self, positional, opts):
+        if set(opts) != {"security-group"}:
+            raise UnsupportedCommand("only --security-group is implemented")
+        port = self._port(positional[0])
+        sg_id = self._secgrp(opts["security-group"])["id"]
+        if sg_id not in port["security_groups"]:
+            body = {"port": {"security_groups": port["security_groups"] + [sg_id]}}
+            self._put("network", f"/v2.0/ports/{port['id']}", body)
+
+    def _fip_list(self, positional, opts):
+        params = {}
+        if network := opts.get("network"):
+            params["floating_network_id"] = self._find(
+                "network", "/v2.0/networks", "networks", network
+            )["id"]
+        if port_id := opts.get("port"):
+            params["port_id"] = port_id
+        if address := opts.get("fixed-ip-address"):
+            params["fixed_ip_address"] = address
+        fips = self._get("network", "/v2.0/floatingips", params=params)
+        return [
+            {
+                "ID": fip["id"],
+                "Floating IP Address": fip["floating_ip_address"],
+                "Fixed IP Address": fip["fixed_ip_address"],
+                "Port": fip["port_id"],
+                "Floating Network": fip["floating_network_id"],
+                "Project": fip.get("project_id") or fip.get("tenant_id"),
+            }
+            for fip in fips["floatingips"]
+        ]
+
+    def _fip_create(self, positional, opts):
+        network = self._find("network", "/v2.0/networks", "networks", positional[0])
+        fip = {"floating_network_id": network["id"]}
+        if port_id := opts.get("port"):
+            fip["port_id"] = port_id
+        if address := opts.get("fixed-ip-address"):
+            fip["fixed_ip_address"] = address
+        body = {"floatingip": fip}
+        return self._post("network", "/v2.0/floatingips", body)["floatingip"]
+
+    def _fip_delete(self, positional, opts):
+        for fip in positional:
+            if not self.UUID_RE.match(fip):
+                params = {"floating_ip_address": fip}
+                found = self._get("network", "/v2.0/floatingips", params=params)
+                if not found["floatingips"]:
+                    raise UnsupportedCommand(f"unknown floating IP {fip}")
+                fip = found["floatingips"][0]["id"]
+            self._delete("network", f"/v2.0/floatingips/{fip}")
+
+    # Load balancers, either Octavia or Neutron LBaaS v2
+
+    def _lbaas_find(self, api, resource, name_or_id):
+        service_type, base = api
+        collection = resource + "s"
+        return self._find(service_type, f"{base}/{collection}", collection, name_or_id)
+
+    def _lbaas_list(self, api, resource, positional, opts):
+        service_type, base = api
+        params = {}
+        if name := opts.get("name"):
+            params["name"] = name
+        if loadbalancer := opts.get("loadbalancer"):
+            params["loadbalancer_id"] = self._lbaas_find(
+                api, "loadbalancer", loadbalancer
+            )["id"]
+        collection = resource + "s"
+        return self._get(service_type, f"{base}/{collection}", params=params)[
+            collection
+        ]
+
+    def _lbaas_show(self, api, resource, positional, opts):
+        return self._lbaas_find(api, resource, positional[0])
+
+    def _lbaas_create(self, api, resource, positional, opts):
+        service_type, base = api
+        body = {}
+        for key, value in opts.items():
+            field = key.replace("-", "_")
+            if field in ("protocol_port", "delay", "max_retries", "timeout"):
+                value = int(value)
+            elif field in ("loadbalancer", "listener"):
+                field, value = field + "_id", self._lbaas_find(api, field, value)["id"]
+            elif field in ("vip_subnet_id", "subnet_id"):
+                value = self._subnet(value)["id"]
+            body[field] = value
+        if resource == "loadbalancer" and positional:
+            # neutron lbaas-loadbalancer-create takes the subnet positionally
+            body["vip_subnet_id"] = self._subnet(positional[0])["id"]
+        elif resource == "healthmonitor" and positional:
+            body["pool_id"] = self._lbaas_find(api, "pool", positional[0])["id"]
+        elif resource == "listener" and positional:
+            body["loadbalancer_id"] = self._lbaas_find(
+                api, "loadbalancer", positional[0]
+            )["id"]
+        collection = resource + "s"
+        resp = self._post(service_type, f"{base}/{collection}", {resource: body})
+        return resp[resource]
+
+    def _lbaas_delete(self, api, resource, positional, opts):
+        service_type, base = api
+        item = self._lbaas_find(api, resource, positional[0])
+        params = {"cascade": "true"} if opts.get("cascade") else None
+        self._delete(service_type, f"{base}/{resource}s/{item['id']}", params=params)
+
+    def _members_path(self, api, pool):
+        _, base = api
+        return "{}/pools/{}/members".format(
+            base, self._lbaas_find(api, "pool", pool)["id"]
+        )
+
+    def _member_list(self, api, positional, opts):
+        service_type, _ = api
+        return self._get(service_type, self._members_path(api, positional[0]))[
+            "members"
+        ]
+
+    def _member_create(self, api, positional, opts):
+        service_type, _ = api
+        member = {
+            "name": opts.get("name"),
+            "address": opts["address"],
+            "protocol_port": int(opts["protocol-port"]),
+        }
+        if subnet := opts.get("subnet-id") or opts.get("subnet"):
+            member["subnet_id"] = self._subnet(subnet)["id"]
+        path = self._members_path(api, positional[0])
+        return self._post(service_type, path, {"member": member})["member"]
+
+    def _member_delete(self, api, member_first, positional, opts):
+        service_type, _ = api
+        member, pool = positional if member_first else reversed(positional)
+        path = self._members_path(api, pool)
+        found = self._find(service_type, path, "members", member)
+        self._delete(service_type, f"{path}/{found['id']}")
+
+
+API_TRANSPORTS = {"native": NativeTransport, "cli": CLITransport}
+
+
+@lru_cache(maxsize=1)
+def _transport_for(name, creds_key):
+    """Create the transport, reused for as long as the creds don't change."""
+    if name == "native":
+        try:
+            return NativeTransport(json.loads(creds_key))
+        except ImportError:
+            log_err("keystoneauth1 is unavailable, using the CLI transport")
+    return CLITransport()
+
+
+def _get_transport():
+    name = hookenv.config().get("api-transport") or "native"
+    if name not in API_TRANSPORTS:
+        log_err("Unknown api-transport {}, using the CLI transport", name)
+        name = "cli"
+    return _transport_for(name, json.dumps(_load_creds(), sort_keys=True))
 
 
 @contextlib.contextmanager
@@ -438,14 +1770,43 @@ def _determine_version(attrs, endpoint, endpoint_tls_ca):
     if url_ver:
         return url_ver.group(1)
 
+    return _discover_version(endpoint, endpoint_tls_ca)
+
+
+@lru_cache(maxsize=None)
+def _discover_version(endpoint, endpoint_tls_ca):
+    """
+    Query the endpoint for its API version.
+
+    Discovered versions are stored in unitdata, keyed by the endpoint and a
+    fingerprint of its CA, so that the endpoint is only queried again once
+    either of them changes or the cache is cleared.  Failures are only
+    remembered until the end of the hook.
+    """
+    key = "{}.{}".format(
+        API_VERSION_KEY,
+        fingerprint({"auth_url": endpoint, "ca": endpoint_tls_ca or ""}),
+    )
+    cached = kv().get(key)
+    if isinstance(cached, dict) and cached.get("version"):
+        return cached["version"]
+
     version = None
 
+    proxies = _proxies()
+    if proxy_bypass_environment(
+        urlparse(endpoint).hostname or "", {"no": proxies.pop("no_proxy", "")}
+    ):
+        proxies = {}
     with _ca_cert_temp(endpoint_tls_ca) as ca_file:
         try:
-            with openstack_proxied(os.environ):
-                with urlopen(endpoint, cafile=ca_file, timeout=ENDPOINT_TIMEOUT) as fp:
-                    info = json.loads(fp.read(600).decode("utf8"))
-                    version = str(info["version"]["id"]).split(".")[0].lstrip("v")
+            opener = build_opener(
+                ProxyHandler(proxies),
+                HTTPSHandler(context=ssl.create_default_context(cafile=ca_file)),
+            )
+            with opener.open(endpoint, timeout=ENDPOINT_TIMEOUT) as fp:
+                info = json.loads(fp.read(600).decode("utf8"))
+                version = str(info["version"]["id"]).split(".")[0].lstrip("v")
         except (
             HTTPError,
             json.JSONDecodeError,
@@ -455,9 +1816,16 @@ def _determine_version(attrs, endpoint, endpoint_tls_ca):
             TimeoutError,
         ) as e:
             log_err("Failed to determine API version: {}", e)
+    if version:
+        kv().set(key, {"auth_url": endpoint, "version": version})
     return version
 
 
+def clear_api_version_cache():
+    _discover_version.cache_clear()
+    kv().unsetrange(prefix=API_VERSION_KEY + ".")
+
+
 def _is_base64(s):
     """
     Verify is the utf8 encoded string is base64 encoded or not
@@ -474,6 +1842,74 @@ def get_all_cached_lbs():
     return kv().getrange("{}.".format(CACHED_LB_PREFIX))
 
 
+def delete_loadbalancers(cached_lbs, max_workers, timeout):
+    """
+    Delete the LBs with the given cached info, and wait for them to be gone.
+
+    The deletes are issued concurrently, after which the LBs are listed
+    until they're all gone or timeout seconds have passed since starting.
+    Deletes which would still be waiting on the LB at that point are
+    abandoned.  The cached info of each LB is only removed once it's gone,
+    so that the LBs still pending or which failed to be deleted aren't
+    forgotten.
+
+    Returns the names of the deleted, pending and failed LBs.
+    """
+    deadline = monotonic() + timeout
+
+    def _delete(lb):
+        if monotonic() >= deadline:
+            raise TimeoutError("Timed out before deleting {}".format(lb.name))
+        lb._impl.delete_loadbalancer(deadline=deadline)
+
+    lbs = [LoadBalancer.load_from_cached(info) for info in cached_lbs]
+    pending, failed = {}, []
+    for lb, future in run_concurrently(_delete, lbs, max_workers):
+        try:
+            future.result()
+        except TimeoutError as e:
+            log_err("{}", e)
+        except Exception as e:
+            if not (isinstance(e, subprocess.CalledProcessError) and _is_not_found(e)):
+                log_err("Failed to delete load balancer {}: {}", lb.name, e)
+                failed.append(lb.name)
+                continue
+        pending[lb.name] = lb
+
+    deleted = []
+    for _ in _backoff(deadline):
+        if pending:
+            any_lb = next(iter(pending.values()))
+            try:
+                existing = {lb["name"] for lb in any_lb._impl.list_loadbalancers()}
+            except subprocess.CalledProcessError as e:
+                log_err("Failed to list load balancers: {}", e)
+                break
+            for name in [name for name in pending if name not in existing]:
+                pending.pop(name)._remove_cached_info()
+                deleted.append(name)
+                log("Load balancer {} was deleted", name)
+        if not pending:
+            break
+    return deleted, sorted(pending), failed
+
+
+def _backoff(deadline):
+    """
+    Yield until the given monotonic deadline passes, sleeping for an
+    exponentially increasing, jittered interval before each yield but the
+    first.
+    """
+    interval = WAIT_INITIAL_INTERVAL
+    while True:
+        yield
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return
+        sleep(min(random.uniform(interval / 2, interval), remaining))
+        interval = min(interval * 2, WAIT_MAX_INTERVAL)
+
+
 class LoadBalancer:
     """
     Base class for wrapper around the OpenStack CLI.
@@ -482,16 +1918,34 @@ class LoadBalancer:
     octavia_available = None
 
     @classmethod
-    def get_or_create(cls, app_name, port, subnet, algorithm, fip_net, manage_secgrps):
+    def get_or_create(
+        cls,
+        app_name,
+        port,
+        subnet,
+        algorithm,
+        fip_net,
+        manage_secgrps,
+        members=None,
+        refresh=False,
+    ):
         """
         Create a client instance for the given LB.
 
         Returns the proper subclass depending on whether Octavia is available.
+        If given, the members are included when the LB is created, where the
+        backend supports it.  If refresh is set, a cached LB is checked
+        against the cloud, and created again if it's gone.
         """
         lb = cls(app_name, port, subnet, algorithm, fip_net, manage_secgrps)
+        if lb.is_created and refresh:
+            try:
+                lb.refresh()
+            except subprocess.CalledProcessError:
+                raise OpenStackLBError(action="update")
         if not lb.is_created:
             try:
-                lb.create()
+                lb.create(members)
             except subprocess.CalledProcessError:
                 raise OpenStackLBError(action="create")
         return lb
@@ -520,22 +1974,31 @@ class LoadBalancer:
         self.manage_secgrps = manage_secgrps
         self.sg_id = None
         self.member_sg_id = None
+        # ledger of the member ports which have the member SG, by address,
+        # and of the member ports which its rules allow traffic to
+        self.member_sg_ports = {}
+        self.member_sg_rules = set()
         self.fip = None
         self.address = None
         self.members = set()
+        # hash of the inputs the LB was last managed with
+        self.inputs_hash = None
         self.is_created = False
         self._impl = self._get_impl()
-        # cache this since we access it multiple times
-        self.is_port_sec_enabled = self._impl.get_port_sec_enabled()
         self._try_load_cached_info()
 
+    @cached_property
+    def is_port_sec_enabled(self):
+        # only probed when needed, so that loading an LB makes no API calls
+        return self._impl.get_port_sec_enabled()
+
     @property
     def key(self):
         return "{}.{}".format(CACHED_LB_PREFIX, self.name)
 
     @property
     def name(self):
-        return "openstack-integrator-{}-{}".format(MODEL_SHORT_ID, self.app_name)
+        return _lb_name(self.app_name)
 
     def get_all(self):
         lbs = []
@@ -568,21 +2031,40 @@ class LoadBalancer:
                 self.manage_secgrps,
             )
 
-    def create(self):
+    def create(self, members=None):
         """
         Create this loadbalancer for the first time.
+
+        Where the backend supports it, a new LB is created along with its
+        listener, pool, members and health monitor in a single request.  The
+        remaining steps then only find what already exists, but still serve
+        to complete a partially created LB, or one on a backend which can
+        only create each part in turn.
         """
+        created_members = set()
         # we may have a partially created LB, so we need to check
         # whether we successfully got past creating the LB itself, or
         # even if the partial-LB was manually cleaned up by the operator
-        lb_info = self._find("load balancers", self._impl.list_loadbalancers())
+        lb_info = self._find(
+            "load balancers", self._impl.list_loadbalancers(name=self.name)
+        )
         if lb_info:
             # list doesn't contain all of the info we need
             lb_info = self._impl.show_loadbalancer()
             log("Found existing load balancer {} ({})", self.name, lb_info["id"])
         else:
-            lb_info = self._impl.create_loadbalancer()
-            log("Created load balancer {} ({})", self.name, lb_info["id"])
+            try:
+                lb_info = self._impl.create_populated_loadbalancer(members or ())
+                created_members = set(members or ())
+                log(
+                    "Created load balancer {} ({}) with {} members",
+                    self.name,
+                    lb_info["id"],
+                    len(created_members),
+                )
+            except NotImplementedError:
+                lb_info = self._impl.create_loadbalancer()
+                log("Created load balancer {} ({})", self.name, lb_info["id"])
             self._wait_lb_not_pending()
         self.address = lb_info["vip_address"]
 
@@ -616,7 +2098,7 @@ class LoadBalancer:
             # therefore only an admin or Octavia itself can access it.
             if self.sg_id:
                 subnet_cidr = self._impl.get_subnet_cidr(self.subnet)
-                self._impl.create_sg_rule(sg_id, subnet_cidr, self.port)
+                self._create_sg_rule(sg_id, subnet_cidr, self.port)
                 log(
                     "Added rule for {}:{} to security group {} ({})",
                     self.address,
@@ -651,7 +2133,7 @@ class LoadBalancer:
             log("Found existing pool {}", self.name)
 
         if self.fip_net:
-            for fip in self._impl.list_fips():
+            for fip in self._impl.list_fips(port_id=lb_info["vip_port_id"]):
                 # why are these keys so inconsistent? :(
                 if fip["Fixed IP Address"] == self.address:
                     self.fip = fip["Floating IP Address"]
@@ -667,6 +2149,10 @@ class LoadBalancer:
 
         if self.is_port_sec_enabled:
             self._create_member_sg()
+            if created_members:
+                # leave any members which couldn't be secured for
+                # update_members to retry
+                self.members -= self._secure_members(created_members)
 
         lb_healthmonitor_info = self._find(
             "loadbalancer healthmonitors", self._impl.list_healthmonitors()
@@ -687,12 +2173,28 @@ class LoadBalancer:
         self.is_created = True
 
     def _wait_not_pending(self, show_func):
-        lb_status = None
-        for retry in range(30):
+        """
+        Wait until the resource shown by show_func is no longer pending.
+
+        The status is probed with an exponentially increasing, jittered
+        interval until the lb-wait-timeout deadline passes.
+        """
+        timeout = float(hookenv.config().get("lb-wait-timeout") or 0)
+        start = monotonic()
+        probes = 0
+        for _ in _backoff(start + timeout):
             lb_status = show_func()["provisioning_status"]
+            probes += 1
             if not lb_status.startswith("PENDING_"):
                 break
-            sleep(2)
+        log(
+            "Waited {:.1f}s with {} probes for {} {} to be {}",
+            monotonic() - start,
+            probes,
+            getattr(show_func, "__name__", "show"),
+            self.name,
+            lb_status,
+        )
 
         if lb_status != "ACTIVE":
             log_err(
@@ -711,19 +2213,23 @@ class LoadBalancer:
         if not isinstance(self._impl, NeutronLBImpl):
             self._wait_not_pending(self._impl.show_pool)
 
+    def _sg_rules(self, sg_id) -> "SecurityGroupRules":
+        """
+        Get the index of the rules of the given security group, which is
+        shared by all LBs for the rest of the hook.
+        """
+        with _sg_rule_indexes_lock:
+            if sg_id not in _sg_rule_indexes:
+                rules = self._impl.list_sg_rules(sg_id)
+                _sg_rule_indexes[sg_id] = SecurityGroupRules(rules)
+            return _sg_rule_indexes[sg_id]
+
     def _find_matching_sg_rule(self, sg_id, address, port):
-        address = ip_address(address)
-        port = int(port)
-        for rule in self._impl.list_sg_rules(sg_id):
-            if rule["Port Range"]:
-                port_min, port_max = rule["Port Range"].split(":")
-                port_match = int(port_min) <= int(port) <= int(port_max)
-            else:
-                port_match = True
-            ip_match = address in ip_network(rule["IP Range"] or "0.0.0.0/0")
-            if port_match and ip_match:
-                return True
-        return False
+        return self._sg_rules(sg_id).allows(address, port)
+
+    def _create_sg_rule(self, sg_id, cidr, port):
+        self._impl.create_sg_rule(sg_id, cidr, port)
+        self._sg_rules(sg_id).add(cidr, port)
 
     def _find(self, description, items):
         """
@@ -742,33 +2248,157 @@ class LoadBalancer:
     def update_members(self, members):
         """
         Add or remove members to the load balancer to match the given set.
+
+        The port security group changes for the added members are made
+        concurrently.  Where the backend can replace the pool's membership
+        in one call, that's done and waited on once; otherwise the members
+        are changed one after another, since the load balancer can't be
+        changed again until it has applied the previous change.
+
+        Members which fail are reported together once all others are done.
         """
         members = set(members)
         # prime the members cache before update of pre-existing LB lp#1959720
         if not self.members:
             self.members = self._impl.list_members()
         if self.members == members:
+            # a member may have been rebuilt on a new port with the same address
+            if self.is_port_sec_enabled and (
+                failed := self._secure_members(members, recheck=True)
+            ):
+                raise OpenStackLBError(action="update", exc=False, members=failed)
             return
 
-        try:
-            removed_members = self.members - members
-            for member in removed_members:
-                self._impl.delete_member(member)
-                log("Removed member: {}", member)
-                self._wait_pool_not_pending()
+        removed_members = self.members - members
+        added_members = members - self.members
+        failed_removes, failed_adds = set(), set()
 
-            added_members = members - self.members
-            for member in added_members:
-                self._impl.create_member(member)
-                if self.is_port_sec_enabled:
-                    self._add_member_sg(member, raise_on_err=True)
-                log("Added member: {}", member)
+        if self.is_port_sec_enabled:
+            failed_adds |= self._secure_members(added_members)
+
+        if added_members - failed_adds or removed_members:
+            try:
+                self._impl.replace_members(members - failed_adds)
+                log("Replaced members: -{} +{}", removed_members, added_members)
                 self._wait_pool_not_pending()
+            except NotImplementedError:
+                failed = self._update_members_each(
+                    removed_members, added_members - failed_adds
+                )
+                failed_removes |= failed & removed_members
+                failed_adds |= failed & added_members
+            except (subprocess.CalledProcessError, OpenStackLBError):
+                log_err("Unable to replace members\n{}", format_exc())
+                failed_removes |= removed_members
+                failed_adds |= added_members
+
+        self.members = (members - failed_adds) | failed_removes
+        # a removed member's port may be reused by something else
+        addresses = {addr for addr, _ in self.members}
+        for addr in list(self.member_sg_ports):
+            if addr not in addresses:
+                del self.member_sg_ports[addr]
+        self._update_cached_info()
+        if failed_adds or failed_removes:
+            raise OpenStackLBError(
+                action="member-add" if failed_adds else "update",
+                exc=False,
+                members=failed_adds | failed_removes,
+            )
+
+    def _secure_members(self, members, recheck=False):
+        """
+        Add the member security group to the ports of the given members, and
+        allow traffic from the LB to the members' ports.
+
+        The ports are found with a single listing of the subnet, which is
+        skipped if the ledgers record every member as secured, unless asked
+        to recheck them.  Once listed, only ports which don't have the group,
+        such as the new port of a rebuilt member, are updated, concurrently.
+        The rules are likewise only checked against the security group for
+        ports missing from the ledger, unless asked to recheck them.
+        Returns the members which couldn't be secured.
+        """
+        members = set(members)
+        failed = set()
+        listed = recheck or any(m[0] not in self.member_sg_ports for m in members)
+        try:
+            ports = self._impl.list_subnet_ports() if listed else {}
         except subprocess.CalledProcessError:
-            raise OpenStackLBError(action="update")
+            log_err("Unable to list ports of {}\n{}", self.subnet, format_exc())
+            return members
+
+        unsecured = {}
+        for member in members if listed else ():
+            addr, port = member
+            if addr not in ports:
+                log_err(f"Unable to find port for {addr=} {port=}")
+                self.member_sg_ports.pop(addr, None)
+                failed.add(member)
+            elif self.member_sg_id not in ports[addr]["security_groups"]:
+                unsecured.setdefault(ports[addr]["id"], set()).add(member)
+            else:
+                self.member_sg_ports[addr] = ports[addr]["id"]
 
-        self.members = members
-        self._update_cached_info()
+        for port_id, future in run_concurrently(
+            lambda port_id: self._impl.set_port_secgrp(port_id, self.member_sg_id),
+            unsecured,
+            hookenv.config().get("lb-member-concurrency") or 1,
+        ):
+            if future.exception():
+                log_err(
+                    "Unable to secure members {}: {}",
+                    unsecured[port_id],
+                    future.exception(),
+                )
+                failed |= unsecured[port_id]
+                for addr, _ in unsecured[port_id]:
+                    self.member_sg_ports.pop(addr, None)
+            else:
+                for addr, _ in unsecured[port_id]:
+                    self.member_sg_ports[addr] = port_id
+
+        rule_ports = {port for _, port in members - failed}
+        if not recheck:
+            rule_ports -= self.member_sg_rules
+        for port in rule_ports:
+            try:
+                self._add_member_sg_rule(port)
+                self.member_sg_rules.add(port)
+            except subprocess.CalledProcessError:
+                log_err("Unable to allow traffic to port {}\n{}", port, format_exc())
+                failed |= {member for member in members if member[1] == port}
+        return failed
+
+    def _update_members_each(self, removed_members, added_members):
+        """
+        Remove and add members one at a time, returning those which failed.
+
+        The pool is only waited on before a change when an earlier one may
+        still be pending, and once at the end for the last to settle.
+        """
+        failed = set()
+        pending = False
+        changes = [
+            (self._impl.delete_member, "Removed", member) for member in removed_members
+        ]
+        changes += [
+            (self._impl.create_member, "Added", member) for member in added_members
+        ]
+        for change, verb, member in changes:
+            try:
+                if pending:
+                    self._wait_pool_not_pending()
+                change(member)
+                pending = True
+                log("{} member: {}", verb, member)
+            except (subprocess.CalledProcessError, OpenStackLBError):
+                log_err("Unable to change member {}\n{}", member, format_exc())
+                failed.add(member)
+
+        if pending:
+            self._wait_pool_not_pending()
+        return failed
 
     def _create_member_sg(self):
         member_sg_name = self.name + "-members"
@@ -778,32 +2408,34 @@ class LoadBalancer:
         else:
             member_sg_id = self._impl.create_secgrp(member_sg_name)
             log("Created security group {} ({})", member_sg_name, member_sg_id)
+        if member_sg_id != self.member_sg_id:
+            # nothing is known about a different group
+            self.member_sg_ports = {}
+            self.member_sg_rules = set()
         self.member_sg_id = member_sg_id
 
-    def _add_member_sg(self, member, raise_on_err):
-        addr, port = member
-        port_id = self._impl.find_port(addr)
-        if not port_id:
-            log_err(f"Unable to find port for {addr=} {port=}")
-            if raise_on_err:
-                raise OpenStackLBError(action="member-add", exc=False)
-            return
-        if (
-            self.member_sg_id
-            not in _openstack("port", "show", port_id)["security_group_ids"]
-        ):
-            self._impl.set_port_secgrp(port_id, self.member_sg_id)
-        if not self._find_matching_sg_rule(self.member_sg_id, self.address, port):
-            subnet_cidr = self._impl.get_subnet_cidr(self.subnet)
-            self._impl.create_sg_rule(self.member_sg_id, subnet_cidr, port)
+    def _add_member_sg_rule(self, port):
+        """Allow traffic from the LB to the given port of the members."""
+        # members are secured concurrently, but must only add each rule once
+        with self._sg_rules(self.member_sg_id).lock:
+            if not self._find_matching_sg_rule(self.member_sg_id, self.address, port):
+                subnet_cidr = self._impl.get_subnet_cidr(self.subnet)
+                self._create_sg_rule(self.member_sg_id, subnet_cidr, port)
 
-    def delete(self):
-        """Delete this loadbalancer and all of its resources."""
+    def refresh(self):
+        """
+        Replace the cached state of the LB with its actual state, which may
+        have been changed out of band.
+        """
         try:
-            self._impl.delete_loadbalancer()
-            self._remove_cached_info()
-        except subprocess.CalledProcessError:
-            raise OpenStackLBError(action="delete")
+            self._impl.show_loadbalancer()
+        except subprocess.CalledProcessError as e:
+            if not _is_not_found(e):
+                raise
+            log("Load balancer {} is gone", self.name)
+            self.is_created = False
+            return
+        self.members = self._impl.list_members()
 
     def _try_load_cached_info(self):
         info = kv().get(self.key)
@@ -813,11 +2445,16 @@ class LoadBalancer:
             self.address = info["address"]
             self.members = {tuple(m) for m in info["members"]}
             self.member_sg_id = info.get("member_sg_id")
-            if self.member_sg_id is None and self.is_port_sec_enabled:
-                # handle upgrade from before the member SG was handled
-                self._create_member_sg()
-                for member in self.members:
-                    self._add_member_sg(member, raise_on_err=False)
+            self.member_sg_ports = info.get("member_sg_ports", {})
+            self.member_sg_rules = set(info.get("member_sg_rules", []))
+            self.inputs_hash = info.get("inputs_hash")
+            if "member_sg_id" not in info:
+                # handle upgrade from before the member SG was handled; the
+                # result is saved so that this only happens once
+                if self.is_port_sec_enabled:
+                    self._create_member_sg()
+                    self._secure_members(self.members)
+                self._update_cached_info()
             self.is_created = True
 
     def _update_cached_info(self):
@@ -831,9 +2468,13 @@ class LoadBalancer:
                 "fip_net": self.fip_net,
                 "manage_secgrps": self.manage_secgrps,
                 "sg_id": self.sg_id,
+                "member_sg_id": self.member_sg_id,
+                "member_sg_ports": dict(self.member_sg_ports),
+                "member_sg_rules": sorted(self.member_sg_rules),
                 "fip": self.fip,
                 "address": self.address,
                 "members": list(self.members),
+                "inputs_hash": self.inputs_hash,
             },
         )
 
@@ -841,6 +2482,45 @@ class LoadBalancer:
         kv().unset(self.key)
 
 
+class SecurityGroupRules:
+    """
+    Index of the ingress TCP rules of a security group, for checking
+    whether traffic from an address to a port is already allowed.
+    """
+
+    def __init__(self, rules):
+        # held while checking for a rule and creating it if it's missing
+        self.lock = threading.Lock()
+        self._rules = []
+        for rule in rules:
+            self.add(rule["IP Range"], rule["Port Range"])
+
+    def add(self, cidr, port_range):
+        """
+        Add a rule for the CIDR (any IPv4 address if empty) and the port or
+        "min:max" range of ports (any port if empty).
+        """
+        if port_range:
+            port_min, _, port_max = str(port_range).partition(":")
+            ports = (int(port_min), int(port_max or port_min))
+        else:
+            ports = (0, 65535)
+        self._rules.append((ports, ip_network(cidr or "0.0.0.0/0", strict=False)))
+
+    def allows(self, address, port) -> bool:
+        address = ip_address(address)
+        port = int(port)
+        return any(
+            port_min <= port <= port_max and address in network
+            for (port_min, port_max), network in self._rules
+        )
+
+
+# rule indexes by security group ID, for the rest of the hook
+_sg_rule_indexes: dict[str, SecurityGroupRules] = {}
+_sg_rule_indexes_lock = threading.Lock()
+
+
 class BaseLBImpl:
     def __init__(self, name, port, subnet, algorithm, fip_net, manage_secgrps):
         self.name = name
@@ -851,8 +2531,17 @@ class BaseLBImpl:
         self.manage_secgrps = manage_secgrps
 
     def find_secgrp(self, name):
-        secgrps = {sg["Name"]: sg for sg in _openstack("security", "group", "list")}
-        return secgrps.get(name, {}).get("ID")
+        try:
+            return _openstack("security", "group", "show", name)["id"]
+        except subprocess.CalledProcessError as e:
+            if _is_not_found(e):
+                return None
+            if not (_is_conflict(e) and (project_id := _project_id())):
+                raise
+        # admin credentials also see the groups of other projects, which the
+        # CLI's show can't be scoped to
+        secgrps = _openstack("security", "group", "list", "--project", project_id)
+        return next((sg["ID"] for sg in secgrps if sg["Name"] == name), None)
 
     def create_secgrp(self, name):
         sg_info = _openstack("security", "group", "create", name)
@@ -883,15 +2572,14 @@ class BaseLBImpl:
         )
 
     def get_port_sec_enabled(self):
-        subnet_info = _openstack("subnet", "show", self.subnet)
-        network_info = _openstack("network", "show", subnet_info["network_id"])
-        return network_info["port_security_enabled"]
+        return port_security_enabled(self.subnet)
 
     def set_port_secgrp(self, port_id, sg_id):
         _openstack("port", "set", "--security-group", sg_id, port_id, yaml_output=False)
 
-    def list_fips(self):
-        return _openstack("floating", "ip", "list", "--network", self.fip_net)
+    def list_fips(self, port_id=None):
+        filters = ("--port", port_id) if port_id else ()
+        return _openstack("floating", "ip", "list", "--network", self.fip_net, *filters)
 
     def create_fip(self, address, port_id):
         fip = _openstack(
@@ -909,27 +2597,28 @@ class BaseLBImpl:
     def delete_fip(self, fip):
         _openstack("floating", "ip", "delete", fip)
 
-    def find_port(self, address) -> Optional[str]:
-        port = _openstack(
-            "port",
-            "list",
-            "--fixed-ip",
-            "subnet={},ip-address={}".format(self.subnet, address),
-            "-c",
-            "ID",
-            "-f",
-            "value",
-        )
-        if not port or "ID" not in port[0]:
-            return None
-        return port[0]["ID"]
+    def list_subnet_ports(self) -> dict:
+        """
+        Get the ports on the subnet, as a dict of each of their fixed IP
+        addresses to the port's ID and security group IDs.
+        """
+        ports = {}
+        for port in _openstack(
+            "port", "list", "--fixed-ip", f"subnet={self.subnet}", "--long"
+        ):
+            for fixed_ip in port["Fixed IP Addresses"]:
+                ports[fixed_ip["ip_address"]] = {
+                    "id": port["ID"],
+                    "security_groups": port["Security Groups"],
+                }
+        return ports
 
     def get_subnet_cidr(self, name):
         return _openstack(
             "subnet", "show", name, "-c", "cidr", "-f", "value", yaml_output=False
         )
 
-    def list_loadbalancers(self):
+    def list_loadbalancers(self, name=None):
         raise NotImplementedError()
 
     def create_loadbalancer(self):
@@ -938,7 +2627,7 @@ class BaseLBImpl:
     def show_loadbalancer(self):
         raise NotImplementedError()
 
-    def delete_loadbalancer(self):
+    def delete_loadbalancer(self, deadline=None):
         raise NotImplementedError()
 
     def list_listeners(self):
@@ -971,6 +2660,17 @@ class BaseLBImpl:
     def delete_member(self, member):
         raise NotImplementedError()
 
+    def replace_members(self, members):
+        """Replace all members of the pool in a single change."""
+        raise NotImplementedError()
+
+    def create_populated_loadbalancer(self, members):
+        """
+        Create the LB along with its listener, pool, members and health
+        monitor in a single change.
+        """
+        raise NotImplementedError()
+
     def create_healthmonitor(self):
         raise NotImplementedError()
 
@@ -983,8 +2683,12 @@ class OctaviaLBImpl(BaseLBImpl):
     Subclass with implementations specific to Octavia-enabled clouds.
     """
 
-    def list_loadbalancers(self):
-        return _openstack("loadbalancer", "list")
+    # opinionated health monitor designed to monitor the kubernetes master service
+    HEALTHMONITOR = {"delay": 5, "max_retries": 4, "timeout": 10, "type": "TLS-HELLO"}
+
+    def list_loadbalancers(self, name=None):
+        filters = ("--name", name) if name else ()
+        return _openstack("loadbalancer", "list", *filters)
 
     def create_loadbalancer(self):
         return _openstack(
@@ -999,11 +2703,13 @@ class OctaviaLBImpl(BaseLBImpl):
     def show_loadbalancer(self):
         return _openstack("loadbalancer", "show", self.name)
 
-    def delete_loadbalancer(self):
+    def delete_loadbalancer(self, deadline=None):
         _openstack("loadbalancer", "delete", "--cascade", self.name, yaml_output=False)
 
     def list_listeners(self):
-        return _openstack("loadbalancer", "listener", "list")
+        return _openstack(
+            "loadbalancer", "listener", "list", "--loadbalancer", self.name
+        )
 
     def create_listener(self):
         return _openstack(
@@ -1023,7 +2729,7 @@ class OctaviaLBImpl(BaseLBImpl):
         _openstack("loadbalancer", "listener", "delete", self.name)
 
     def list_pools(self):
-        return _openstack("loadbalancer", "pool", "list")
+        return _openstack("loadbalancer", "pool", "list", "--loadbalancer", self.name)
 
     def show_pool(self):
         return _openstack("loadbalancer", "pool", "show", self.name)
@@ -1078,6 +2784,38 @@ class OctaviaLBImpl(BaseLBImpl):
             "loadbalancer", "member", "delete", self.name, addr, yaml_output=False
         )
 
+    def replace_members(self, members):
+        transport = _get_transport()
+        if not isinstance(transport, NativeTransport):
+            # the CLI has no equivalent of the batch member update
+            raise NotImplementedError()
+        transport.replace_members(self.name, members, self.subnet)
+
+    def create_populated_loadbalancer(self, members):
+        transport = _get_transport()
+        if not isinstance(transport, NativeTransport):
+            # the CLI can only create each part of the LB in turn
+            raise NotImplementedError()
+        pool = {
+            "name": self.name,
+            "protocol": "HTTPS",
+            "lb_algorithm": self.algorithm,
+            "members": [
+                {"name": addr, "address": addr, "protocol_port": int(port)}
+                for addr, port in sorted(members)
+            ],
+            "healthmonitor": {"name": self.name, **self.HEALTHMONITOR},
+        }
+        listener = {
+            "name": self.name,
+            "protocol": "HTTPS",
+            "protocol_port": int(self.port),
+            "default_pool": pool,
+        }
+        return transport.create_loadbalancer_graph(
+            {"name": self.name, "listeners": [listener]}, self.subnet
+        )
+
     def create_healthmonitor(self):
         """
         Create an opinionated health monitor
@@ -1090,20 +2828,24 @@ class OctaviaLBImpl(BaseLBImpl):
             "healthmonitor",
             "create",
             "--delay",
-            "5",
+            str(self.HEALTHMONITOR["delay"]),
             "--max-retries",
-            "4",
+            str(self.HEALTHMONITOR["max_retries"]),
             "--timeout",
-            "10",
+            str(self.HEALTHMONITOR["timeout"]),
             "--type",
-            "TLS-HELLO",
+            self.HEALTHMONITOR["type"],
             "--name",
             self.name,
             self.name,
         )
 
     def list_healthmonitors(self) -> list:
-        return _openstack("loadbalancer", "healthmonitor", "list")
+        # only the health monitor of our own pool is of interest
+        hm_id = self.show_pool().get("healthmonitor_id")
+        if not hm_id:
+            return []
+        return [_openstack("loadbalancer", "healthmonitor", "show", hm_id)]
 
 
 class NeutronLBImpl(BaseLBImpl):
@@ -1111,8 +2853,9 @@ class NeutronLBImpl(BaseLBImpl):
     Subclass with implementations specific to non-Octavia-enabled clouds.
     """
 
-    def list_loadbalancers(self):
-        return _neutron("lbaas-loadbalancer-list")
+    def list_loadbalancers(self, name=None):
+        filters = ("--name", name) if name else ()
+        return _neutron("lbaas-loadbalancer-list", *filters)
 
     def create_loadbalancer(self):
         return _neutron("lbaas-loadbalancer-create", "--name", self.name, self.subnet)
@@ -1120,23 +2863,70 @@ class NeutronLBImpl(BaseLBImpl):
     def show_loadbalancer(self):
         return _neutron("lbaas-loadbalancer-show", self.name)
 
-    def delete_loadbalancer(self):
-        for fip in self.list_fips():
-            self.delete_fip(fip)
-
-        for member in self.list_members():
-            self.delete_member(member)
+    def delete_loadbalancer(self, deadline=None):
+        """
+        Delete the LB along with its FIPs, listener, pool and security group.
 
-        self.delete_pool()
-        self.delete_listener()
-        if self.manage_secgrps:
-            sg_id = self.find_secgrp(self.name)
+        The FIPs are independent of the LB, so they're deleted concurrently.
+        Deleting the pool deletes its members, and in between the remaining
+        steps the LB is only waited on while it can't be changed, for no
+        longer than the given monotonic deadline.
+        """
+        lb_info = self.show_loadbalancer()
+        fips = (
+            [
+                fip["Floating IP Address"]
+                for fip in self.list_fips(port_id=lb_info["vip_port_id"])
+            ]
+            if self.fip_net
+            else []
+        )
+        for fip, future in run_concurrently(
+            self.delete_fip, fips, hookenv.config().get("lb-member-concurrency") or 1
+        ):
+            future.result()
+
+        if self.list_pools():
+            self.delete_pool()
+            self._wait_lb(deadline=deadline)
+        if self.list_listeners():
+            self.delete_listener()
+            self._wait_lb(deadline=deadline)
+        _neutron("lbaas-loadbalancer-delete", self.name)
+
+        if self.manage_secgrps and (sg_id := self.find_secgrp(self.name)):
+            # the security group is in use until the VIP port is gone
+            self._wait_lb(until_gone=True, deadline=deadline)
             self.delete_secgrp(sg_id)
 
-        return _neutron("lbaas-loadbalancer-delete", self.name)
+    def _wait_lb(self, until_gone=False, deadline=None):
+        """
+        Wait for up to lb-wait-timeout until the LB is no longer pending,
+        or if until_gone is set, until it no longer exists.
+
+        Raises TimeoutError if the given monotonic deadline passes first.
+        """
+        timeout = float(hookenv.config().get("lb-wait-timeout") or 0)
+        wait_deadline = monotonic() + timeout
+        if deadline is not None:
+            wait_deadline = min(wait_deadline, deadline)
+        for _ in _backoff(wait_deadline):
+            try:
+                lb_status = self.show_loadbalancer()["provisioning_status"]
+            except subprocess.CalledProcessError as e:
+                if _is_not_found(e):
+                    return
+                raise
+            if not until_gone and not lb_status.startswith("PENDING_"):
+                return
+        if deadline is not None and monotonic() >= deadline:
+            raise TimeoutError(
+                "Timed out deleting {} in {}".format(self.name, lb_status)
+            )
+        log_err("Timed out waiting for {} in {}", self.name, lb_status)
 
     def list_listeners(self):
-        return _neutron("lbaas-listener-list")
+        return _neutron("lbaas-listener-list", "--name", self.name)
 
     def create_listener(self):
         return _neutron(
@@ -1155,7 +2945,7 @@ class NeutronLBImpl(BaseLBImpl):
         _neutron("lbaas-listener-delete", self.name)
 
     def list_pools(self):
-        return _neutron("lbaas-pool-list")
+        return _neutron("lbaas-pool-list", "--name", self.name)
 
     def show_pool(self):
         return _neutron("lbaas-pool-show", self.name)
@@ -1,6 +1,8 @@
+from time import time
+from traceback import format_exc
 from typing import TYPE_CHECKING, Any, Mapping, Optional
 from str2bool import str2bool
-from charmhelpers.core import hookenv
+from charmhelpers.core import hookenv, unitdata
 from charms.reactive import (
     hook,
     when_all,
@@ -24,6 +26,84 @@ if TYPE_CHECKING:
 SUPPORTED_LB_PROTOS = ["udp", "tcp"]
 SUPPORTED_LB_ALGS = ["ROUND_ROBIN", "LEAST_CONNECTIONS", "SOURCE_IP"]
 SUPPORTED_LB_HC_PROTOS = ["http", "https", "tcp"]
+SUPPORTED_PUBLISH_MODES = ["unit", "app", "both"]
+CLIENTS_PUBLISHED_KEY = "charm.openstack.clients.published"
+LB_DRIFT_CHECKED_KEY = "charm.openstack.loadbalancer.drift-checked"
+
+# the config options each part of the charm depends on, so that a config
+# change only refreshes the parts which use the changed options
+CONFIG_DEPENDENCIES = {
+    "credentials": [
+        "credentials",
+        "auth-url",
+        "username",
+        "password",
+        "domain-name",
+        "domain-id",
+        "project-name",
+        "project-id",
+        "user-domain-name",
+        "user-domain-id",
+        "project-domain-name",
+        "project-domain-id",
+        "region",
+        "endpoint-tls-ca",
+    ],
+    "proxy": [
+        "http-proxy",
+        "https-proxy",
+        "no-proxy",
+        "web-proxy-enable",
+    ],
+    "clients-lbaas": [
+        "subnet-id",
+        "floating-network-id",
+        "lb-method",
+        "manage-security-groups",
+        "lb-enabled",
+        "internal-lb",
+    ],
+    "clients-block-storage": [
+        "bs-version",
+        "trust-device-path",
+        "ignore-volume-az",
+    ],
+    "clients-publishing": [
+        "clients-publish-mode",
+        "clients-credentials-secret",
+    ],
+    "lb-consumers": [
+        "lb-subnet",
+        "lb-floating-network",
+        "lb-port",
+        "lb-method",
+        "manage-security-groups",
+    ],
+    "loadbalancer": [
+        "lb-subnet",
+        "lb-floating-network",
+        "lb-port",
+        "lb-method",
+        "manage-security-groups",
+    ],
+}
+CLIENTS_CONFIG = ["clients-lbaas", "clients-block-storage", "clients-publishing"]
+
+
+def _config_flags(*parts):
+    """The config.changed flags for the options the given parts depend on."""
+    return sorted(
+        {
+            "config.changed.{}".format(key)
+            for part in parts
+            for key in CONFIG_DEPENDENCIES[part]
+        }
+    )
+
+
+def _config_changed(*parts):
+    """Whether any option the given parts depend on has changed."""
+    return any(is_flag_set(flag) for flag in _config_flags(*parts))
 
 
 @when_all("snap.installed.openstackclients")
@@ -32,32 +112,12 @@ def set_app_ver():
     hookenv.application_version_set(version)
 
 
-@when_any(
-    "config.changed.credentials",
-    "config.changed.auth-url",
-    "config.changed.username",
-    "config.changed.password",
-    "config.changed.domain-name",
-    "config.changed.domain-id",
-    "config.changed.project-name",
-    "config.changed.project-id",
-    "config.changed.user-domain-name",
-    "config.changed.user-domain-id",
-    "config.changed.project-domain-name",
-    "config.changed.project-domain-id",
-    "config.changed.region",
-    "config.changed.endpoint-tls-ca",
-)
+@when_any(*_config_flags("credentials"))
 def update_creds():
     clear_flag("charm.openstack.creds.set")
 
 
-@when_any(
-    "config.changed.http-proxy",
-    "config.changed.https-proxy",
-    "config.changed.no-proxy",
-    "config.changed.web-proxy-enable",
-)
+@when_any(*_config_flags("proxy"))
 def update_proxy():
     clear_flag("charm.openstack.proxy.set")
 
@@ -66,6 +126,8 @@ def update_proxy():
 def upgrade_charm():
     # when the charm is upgraded, recheck the creds in case anything
     # has changed or we want to handle any of the fields differently
+    layer.openstack.clear_creds_fingerprint()
+    unitdata.kv().unsetrange(prefix=CLIENTS_PUBLISHED_KEY + ".")
     clear_flag("charm.openstack.creds.set")
     clear_flag("charm.openstack.proxy.set")
 
@@ -129,7 +191,7 @@ def lb_manage_security_groups(config: Mapping[str, Any]) -> Optional[bool]:
 )
 @when_any(
     "endpoint.clients.requests-pending",
-    "config.changed",
+    *_config_flags(*CLIENTS_CONFIG),
     "charm.openstack.creds.changed",
     "charm.openstack.proxy.changed",
 )
@@ -142,43 +204,136 @@ def handle_requests():
     if (manage_security_groups := lb_manage_security_groups(config)) is None:
         layer.status.blocked(f"Invalid value for config {manage_security_groups=}")
         return
+    publish_mode = config.get("clients-publish-mode")
+    if publish_mode not in SUPPORTED_PUBLISH_MODES:
+        layer.status.blocked(f"Invalid value for config {publish_mode=}")
+        return
 
-    settings = layer.openstack.cached_openstack_proxied()
-    config_change = is_flag_set("config.changed")
+    config_change = _config_changed(*CLIENTS_CONFIG)
     creds_changed = is_flag_set("charm.openstack.creds.changed")
     proxy_changed = is_flag_set("charm.openstack.proxy.changed")
     refresh_requests = config_change or creds_changed or proxy_changed
-    requests = clients.all_requests if refresh_requests else clients.new_requests
+    new_requests = clients.new_requests
+    requests = clients.all_requests if refresh_requests else new_requests
+    publish_app = publish_mode != "unit" and hookenv.is_leader()
+    publish_units = publish_mode != "app"
+    secret_id = None
+    if requests and config["clients-credentials-secret"]:
+        _clear_plain_credentials(clients, hookenv.is_leader())
+    if requests and (publish_app or publish_units):
+        if config["clients-credentials-secret"]:
+            secret_id = layer.openstack.credentials_secret(
+                [relation.relation_id for relation in clients.relations]
+            )
+        payload = _client_payload(
+            config, manage_security_groups, has_octavia, secret_id
+        )
+        digest = layer.openstack.fingerprint(payload)
+        if publish_app:
+            _publish_app_data(clients, payload, digest)
+        if publish_units and secret_id:
+            for relation in clients.relations:
+                relation.to_publish["credentials_secret_id"] = secret_id
+    if not publish_units:
+        # everything is in the application data, so the units only need to
+        # be told their requests are complete
+        requests = []
+    new_units = {request.unit_name for request in new_requests}
+    skipped = 0
     for request in requests:
+        key = "{}.{}".format(CLIENTS_PUBLISHED_KEY, request.unit_name)
+        if request.unit_name not in new_units and unitdata.kv().get(key) == digest:
+            skipped += 1
+            continue
         layer.status.maintenance("Granting request for {}".format(request.unit_name))
-        creds = layer.openstack.get_credentials()
-        request.set_proxy_config(settings)
-        request.set_credentials(**creds)
-        request.set_lbaas_config(
-            config["subnet-id"],
-            config["floating-network-id"],
-            config["lb-method"],
-            manage_security_groups,
-            has_octavia,
+        request.set_proxy_config(payload["proxy_config"])
+        if not secret_id:
+            request.set_credentials(**payload["credentials"])
+        request.set_lbaas_config(**payload["lbaas_config"])
+        request.set_block_storage_config(**payload["block_storage_config"])
+        unitdata.kv().set(key, digest)
+        layer.openstack.log("Finished request for {}", request.unit_name)
+    if skipped:
+        layer.openstack.log(
+            "Skipped {} of {} client units with unchanged data", skipped, len(requests)
+        )
+    clients.mark_completed()
+    clear_flag("charm.openstack.creds.changed")
+    clear_flag("charm.openstack.proxy.changed")
+
+
+def _client_payload(config, manage_security_groups, has_octavia, secret_id=None):
+    """
+    Build the data which is sent to every unit of the clients endpoint.
+
+    If the credentials are shared through a Juju secret, only its ID is sent.
+    """
+
+    def _or_none(val):
+        if val in (None, "", "null"):
+            return None
+        else:
+            return val
+
+    return {
+        "proxy_config": layer.openstack.cached_openstack_proxied(),
+        "credentials": (
+            {"credentials_secret_id": secret_id}
+            if secret_id
+            else layer.openstack.get_credentials()
+        ),
+        "lbaas_config": dict(
+            subnet_id=config["subnet-id"],
+            floating_network_id=config["floating-network-id"],
+            lb_method=config["lb-method"],
+            manage_security_groups=manage_security_groups,
+            has_octavia=has_octavia,
             lb_enabled=config["lb-enabled"],
             internal_lb=config["internal-lb"],
-        )
+        ),
+        "block_storage_config": dict(
+            bs_version=_or_none(config.get("bs-version")),
+            trust_device_path=_or_none(config.get("trust-device-path")),
+            ignore_volume_az=_or_none(config.get("ignore-volume-az")),
+        ),
+    }
 
-        def _or_none(val):
-            if val in (None, "", "null"):
-                return None
-            else:
-                return val
 
-        request.set_block_storage_config(
-            _or_none(config.get("bs-version")),
-            _or_none(config.get("trust-device-path")),
-            _or_none(config.get("ignore-volume-az")),
+def _publish_app_data(clients, payload, digest):
+    """
+    Write the clients payload to the application data of each relation.
+
+    The nested payload is flattened to the same keys the requests set on
+    the unit data.
+    """
+    data = {"proxy_config": payload["proxy_config"]}
+    for key in ("credentials", "lbaas_config", "block_storage_config"):
+        data.update(payload[key])
+    for relation in clients.relations:
+        key = "{}.app.{}".format(CLIENTS_PUBLISHED_KEY, relation.relation_id)
+        if unitdata.kv().get(key) == digest:
+            continue
+        relation.to_publish_app.update(data)
+        unitdata.kv().set(key, digest)
+        layer.openstack.log(
+            "Published application data for {}", relation.application_name
         )
-        layer.openstack.log("Finished request for {}", request.unit_name)
-    clients.mark_completed()
-    clear_flag("charm.openstack.creds.changed")
-    clear_flag("charm.openstack.proxy.changed")
+
+
+def _clear_plain_credentials(clients, leader):
+    """
+    Remove credentials previously published in plain text from the unit data
+    and, on the leader, from the application data of each relation.
+    """
+    keys = layer.openstack.get_credentials().keys()
+    for relation in clients.relations:
+        databags = [relation.to_publish]
+        if leader:
+            databags.append(relation.to_publish_app)
+        for databag in databags:
+            for key in keys:
+                if databag.get(key) is not None:
+                    databag[key] = None
 
 
 @when_all("charm.openstack.creds.set", "credentials.connected")
@@ -284,22 +439,44 @@ def _validate_loadbalancer_request(request: "LBRequest") -> "LBResponse":
 @when_all("charm.openstack.creds.set", "endpoint.loadbalancer.joined")
 @when_not("upgrade.series.in-progress")
 def manage_loadbalancers_via_loadbalancer():
-    layer.status.maintenance("Managing load balancers")
     config = hookenv.config()
     lb_port = str(config["lb-port"])
     lb_clients = endpoint_from_name("loadbalancer")
+    # this runs in every hook, so LBs are only reconciled against the cloud
+    # when their requests or config change, or a drift check is due
+    last_checked = unitdata.kv().get(LB_DRIFT_CHECKED_KEY) or 0
+    check_drift = (
+        _config_changed("loadbalancer")
+        or is_flag_set("charm.openstack.creds.changed")
+        or time() >= last_checked + config["lb-drift-check-interval"]
+    )
     try:
         for request in lb_clients.requests:
             if not request.members:
                 continue
+            lb_algo = _lb_algo(request)
+            cached = None
+            if not check_drift:
+                cached = layer.openstack.get_unchanged_loadbalancer(
+                    request.application_name, request.members, lb_port, lb_algo
+                )
+            if cached:
+                request.set_address_port(
+                    cached["fip"] or cached["address"], cached["port"]
+                )
+                continue
+            layer.status.maintenance("Managing load balancers")
             lb = layer.openstack.manage_loadbalancer(
                 request.application_name,
                 request.members,
                 lb_port,
-                _lb_algo(request),
+                lb_algo,
                 "loadbalancer",
+                refresh=check_drift,
             )
             request.set_address_port(lb.fip or lb.address, lb.port)
+        if check_drift:
+            unitdata.kv().set(LB_DRIFT_CHECKED_KEY, time())
     except layer.openstack.OpenStackError as e:
         layer.status.blocked(str(e))
 
@@ -307,7 +484,7 @@ def manage_loadbalancers_via_loadbalancer():
 @when_all("charm.openstack.creds.set")
 @when_any(
     "endpoint.lb-consumers.requests_changed",
-    "config.changed",
+    *_config_flags("lb-consumers"),
     "charm.openstack.creds.changed",
     "charm.openstack.proxy.changed",
 )
@@ -316,32 +493,73 @@ def manage_loadbalancers_via_lb_consumers():
     layer.status.maintenance("Managing load balancers")
     lb_consumers = allow_lb_consumers_to_read_requests()
     errors = []
-    config_change = is_flag_set("config.changed")
+    config_change = _config_changed("lb-consumers")
     creds_changed = is_flag_set("charm.openstack.creds.changed")
     proxy_changed = is_flag_set("charm.openstack.proxy.changed")
     refresh_requests = config_change or creds_changed or proxy_changed
-    requests = (
-        lb_consumers.all_requests if refresh_requests else lb_consumers.new_requests
-    )
+    new_requests = lb_consumers.new_requests
+    requests = lb_consumers.all_requests if refresh_requests else new_requests
+    new_names = {request.name for request in new_requests}
+    valid_requests = []
+    unchanged = 0
     for request in requests:
         response = _validate_loadbalancer_request(request)
         if response.error_fields:
             lb_consumers.send_response(request)
             continue
+        lb_algo = _lb_algo(request)
+        if request.name not in new_names and request.backends:
+            # replay the last response if nothing the LB depends on changed
+            lb_port, remote_port = next(iter(request.port_mapping.items()))
+            members = [(addr, remote_port) for addr in request.backends]
+            cached = layer.openstack.get_unchanged_loadbalancer(
+                request.name, members, lb_port, lb_algo
+            )
+            if cached:
+                response.address = cached["fip"] or cached["address"]
+                response.error = None
+                response.error_message = ""
+                lb_consumers.send_response(request)
+                unchanged += 1
+                continue
+        valid_requests.append((request, lb_algo))
+    if unchanged:
+        layer.openstack.log("Skipped {} unchanged load balancers", unchanged)
 
+    def _manage_loadbalancer(item):
+        request, lb_algo = item
         lb_port, remote_port = next(iter(request.port_mapping.items()))
+        members = [(addr, remote_port) for addr in request.backends]
+        return layer.openstack.manage_loadbalancer(
+            request.name, members, lb_port, lb_algo, "lb-consumers"
+        )
+
+    # each LB can take minutes to settle, so reconcile several at once and
+    # respond to each request as soon as its LB is done
+    for (request, _), future in layer.openstack.run_concurrently(
+        _manage_loadbalancer, valid_requests, hookenv.config()["lb-concurrency"]
+    ):
+        response = request.response
         try:
-            members = [(addr, remote_port) for addr in request.backends]
-            lb = layer.openstack.manage_loadbalancer(
-                request.name, members, lb_port, _lb_algo(request), "lb-consumers"
-            )
+            lb = future.result()
             response.address = lb.fip or lb.address
             response.error = None
             response.error_message = ""
-        except layer.openstack.OpenStackError as e:
+        except Exception as e:
+            if isinstance(e, layer.openstack.OpenStackError):
+                error_message = str(e)
+            else:
+                # don't let one LB's unexpected failure fail the others
+                hookenv.log(
+                    "Error managing load balancer {}\n{}".format(
+                        request.name, format_exc()
+                    ),
+                    hookenv.ERROR,
+                )
+                error_message = "Error while managing load balancer; check debug-log"
             response.error = response.error_types.provider_error
-            response.error_message = str(e)
-            errors.append(str(e))
+            response.error_message = error_message
+            errors.append(error_message)
         lb_consumers.send_response(request)
     if errors:
         layer.status.blocked(", ".join(errors))
@@ -350,7 +568,15 @@ def manage_loadbalancers_via_lb_consumers():
 @hook("stop")
 def cleanup():
     layer.status.maintenance("Cleaning load balancers")
-    for _, cached_info in layer.openstack.get_all_cached_lbs().items():
-        lb = layer.openstack.LoadBalancer.load_from_cached(cached_info)
-        lb.delete()
-        hookenv.log("loadbalancer '{}' was deleted".format(lb.name))
+    config = hookenv.config()
+    deleted, pending, failed = layer.openstack.delete_loadbalancers(
+        layer.openstack.get_all_cached_lbs().values(),
+        config["lb-concurrency"],
+        config["lb-teardown-timeout"],
+    )
+    hookenv.log(
+        "Deleted {} load balancers; still pending: {}; failed: {}".format(
+            len(deleted), ", ".join(pending) or "none", ", ".join(failed) or "none"
+        ),
+        hookenv.WARNING if pending or failed else hookenv.INFO,
+    )
@@ -1,13 +1,18 @@
+import json
 import os
 import pytest
 import tempfile
+import threading
 from base64 import b64encode
 from pathlib import Path
 from unittest import mock
 
+from requests import Response
+from requests.utils import select_proxy
+
 # patched
 import subprocess
-from urllib.request import urlopen
+from urllib.request import build_opener
 from urllib.error import HTTPError
 import charms.layer
 
@@ -18,6 +23,7 @@ openstack = charms.layer.openstack
 status = charms.layer.status
 
 subprocess: mock.Mock
+urlopen = build_opener.return_value.open
 
 log_err = patch_fixture("charms.layer.openstack.log_err")
 _load_creds = patch_fixture("charms.layer.openstack._load_creds")
@@ -57,6 +63,11 @@ def clean():
         cert_file = Path(tmpdir) / "test.crt"
         openstack.CA_CERT_FILE = cert_file
         openstack.config = {}
+        openstack.clear_read_cache()
+        openstack.clear_subnet_index()
+        openstack._sg_rule_indexes.clear()
+        openstack.clear_creds_fingerprint()
+        openstack.clear_api_version_cache()
         yield
 
 
@@ -88,6 +99,8 @@ def mock_getenv():
 def impl():
     with mock.patch.object(openstack.LoadBalancer, "_get_impl") as _get_impl:
         _get_impl.return_value = mock.Mock(spec=openstack.BaseLBImpl)
+        _get_impl().replace_members.side_effect = NotImplementedError
+        _get_impl().create_populated_loadbalancer.side_effect = NotImplementedError
         yield _get_impl()
 
 
@@ -160,6 +173,7 @@ def test_determine_version_fetch_with_failure(log_err, http_failure):
     assert openstack._determine_version(*args) == "3"
     log_err.assert_not_called()
 
+    openstack.clear_api_version_cache()
     if isinstance(http_failure, Exception):
         urlopen.side_effect = http_failure
     else:
@@ -168,6 +182,94 @@ def test_determine_version_fetch_with_failure(log_err, http_failure):
     log_err.assert_called_once()
 
 
+@mock.patch.object(openstack.ssl, "create_default_context")
+def test_determine_version_cached(create_default_context, log_err):
+    openstack.hookenv.config.return_value = {"web-proxy-enable": False}
+    urlopen.reset_mock()
+    urlopen.side_effect = None
+    read = urlopen.return_value.__enter__().read
+    read.return_value = b'{"version": {"id": "v3.14"}}'
+
+    # discovered once, then reused within the hook and by later hooks
+    assert openstack._determine_version({}, "https://endpoint/", None) == "3"
+    assert openstack._determine_version({}, "https://endpoint/", None) == "3"
+    assert urlopen.call_count == 1
+    openstack._discover_version.cache_clear()
+    assert openstack._determine_version({}, "https://endpoint/", None) == "3"
+    assert urlopen.call_count == 1
+
+    # a different CA or URL is discovered separately
+    assert openstack._determine_version({}, "https://endpoint/", _b64("ca")) == "3"
+    assert openstack._determine_version({}, "https://other/", None) == "3"
+    assert urlopen.call_count == 3
+
+    # failures are only retried in later hooks
+    urlopen.side_effect = TimeoutError()
+    assert openstack._determine_version({}, "https://down/", None) is None
+    assert openstack._determine_version({}, "https://down/", None) is None
+    assert urlopen.call_count == 4
+    openstack._discover_version.cache_clear()
+    assert openstack._determine_version({}, "https://down/", None) is None
+    assert urlopen.call_count == 5
+
+    # clearing the cache forces rediscovery
+    urlopen.side_effect = None
+    openstack.clear_api_version_cache()
+    assert openstack._determine_version({}, "https://endpoint/", None) == "3"
+    assert urlopen.call_count == 6
+    log_err.reset_mock()
+    urlopen.reset_mock()
+
+
+@mock.patch.object(openstack, "proxy_bypass_environment")
+@mock.patch.object(openstack, "ProxyHandler")
+def test_api_calls_proxied(ProxyHandler, proxy_bypass_environment, log_err):
+    openstack.hookenv.config.return_value = {"web-proxy-enable": True}
+    openstack.cached_openstack_proxied.cache_clear()
+    environ = dict(os.environ)
+    expected = {
+        "http": PROXY_EXAMPLE_COM,
+        "https": PROXY_EXAMPLE_COM,
+        "no_proxy": NO_PROXY,
+    }
+    assert openstack._proxies() == expected
+
+    # hosts in no_proxy are reached directly by the API sessions
+    with mock.patch("requests.adapters.HTTPAdapter.send") as send, mock.patch(
+        "requests.utils.proxy_bypass", return_value=False
+    ):
+        send.return_value = Response()
+        requests_session = openstack._proxied_session()
+        for url, proxy in (
+            ("https://keystone.example.com/v3", None),
+            ("https://127.0.0.1:5000/v3", None),
+            ("https://keystone.internal:5000/v3", PROXY_EXAMPLE_COM),
+        ):
+            requests_session.get(url)
+            proxies = send.call_args.kwargs["proxies"]
+            assert select_proxy(url, proxies) == proxy, url
+
+    urlopen.reset_mock()
+    urlopen.side_effect = None
+    urlopen.return_value.__enter__().read.return_value = b'{"version": {"id": "v3"}}'
+    proxy_bypass_environment.return_value = False
+    assert openstack._determine_version({}, "https://endpoint/", None) == "3"
+    proxy_bypass_environment.assert_called_once_with("endpoint", {"no": NO_PROXY})
+    ProxyHandler.assert_called_once_with(
+        {"http": PROXY_EXAMPLE_COM, "https": PROXY_EXAMPLE_COM}
+    )
+
+    # hosts in no_proxy are reached directly
+    openstack.clear_api_version_cache()
+    proxy_bypass_environment.return_value = True
+    assert openstack._determine_version({}, "https://endpoint/", None) == "3"
+    ProxyHandler.assert_called_with({})
+
+    # the proxy settings are passed explicitly, never through the environment
+    assert dict(os.environ) == environ
+    openstack.cached_openstack_proxied.cache_clear()
+
+
 def _b64(s):
     return b64encode(s.encode("utf8")).decode("utf8")
 
@@ -221,6 +323,7 @@ def test_run_with_creds(_load_creds):
         },
         check=True,
         stdout=mock.ANY,
+        stderr=mock.ANY,
         timeout=30.0,
     )
 
@@ -243,7 +346,411 @@ def test_run_with_creds(_load_creds):
     assert "OS_IDENTITY_API_VERSION" not in env
 
 
-def test_default_subnet(_openstack):
+def test_run_with_creds_token(_load_creds):
+    _load_creds.return_value = {
+        "auth_url": "auth_url",
+        "region": "region",
+        "username": "username",
+        "password": "password",
+        "user_domain_name": "user_domain_name",
+        "user_domain_id": "user_domain_id",
+        "project_domain_name": "project_domain_name",
+        "project_name": "project_name",
+        "endpoint_tls_ca": None,
+    }
+    with mock.patch.dict(os.environ, {"PATH": "path"}):
+        openstack._run_with_creds("my", "args", token="token")
+    env = subprocess.run.call_args[1]["env"]
+    assert env["OS_AUTH_TYPE"] == "v3token"
+    assert env["OS_TOKEN"] == "token"
+    assert env["OS_PROJECT_NAME"] == "project_name"
+    for key in ("OS_USERNAME", "OS_PASSWORD", "OS_USER_DOMAIN_NAME"):
+        assert key not in env
+    assert "OS_USER_DOMAIN_ID" not in env
+
+
+def test_token_cache(kv, _load_creds):
+    creds = {"auth_url": "auth_url", "password": "password"}
+    now = openstack.datetime.now(openstack.timezone.utc)
+    expires = now + openstack.timedelta(hours=1)
+    cached = {
+        "creds": openstack.fingerprint(creds),
+        "token": "token",
+        "expires_at": expires.isoformat(),
+        "auth_state": "{}",
+    }
+    kv().get.return_value = cached
+    assert openstack._load_token(creds) is cached
+    assert openstack._keystone_token(creds) == "token"
+    assert openstack._load_token(dict(creds, password="changed")) is None
+
+    cached["expires_at"] = (now + openstack.timedelta(minutes=1)).isoformat()
+    assert openstack._load_token(creds) is None
+
+    _load_creds.return_value = creds
+    openstack._save_creds(creds)
+    kv().unset.assert_not_called()
+    openstack._save_creds(dict(creds, password="changed"))
+    kv().unset.assert_called_once_with("charm.openstack.token")
+
+
+def test_run_concurrently(kv):
+    def work(item):
+        # unitdata access from workers is run on the main thread
+        openstack.kv().set(item, threading.current_thread())
+        if item == "bad":
+            raise openstack.OpenStackError(item)
+        return item.upper()
+
+    results = {
+        item: future.exception() or future.result()
+        for item, future in openstack.run_concurrently(work, ["a", "b", "bad"], 2)
+    }
+    assert results["a"] == "A"
+    assert results["b"] == "B"
+    assert isinstance(results["bad"], openstack.OpenStackError)
+    assert kv().set.call_count == 3
+    for call in kv().set.call_args_list:
+        assert call.args[1] is not threading.main_thread()
+
+
+def test_run_concurrently_stopped_early():
+    failed, done = threading.Event(), []
+
+    def work(item):
+        if item == "bad":
+            failed.set()
+            raise KeyError(item)
+        # still needs the main thread after the caller has given up
+        failed.wait(5)
+        for _ in range(10):
+            openstack.kv().get(item)
+        done.append(item)
+
+    with pytest.raises(KeyError):
+        for item, future in openstack.run_concurrently(work, ["bad", "a", "b"], 3):
+            future.result()
+    assert sorted(done) == ["a", "b"]
+
+
+def test_parse_cli_args():
+    args = ("sg", "--ingress", "--protocol=tcp", "--dst-port", "80", "-c", "ID")
+    assert openstack._parse_cli_args(args) == (
+        ["sg"],
+        {"ingress": True, "protocol": "tcp", "dst-port": "80", "c": "ID"},
+    )
+
+
+@pytest.fixture
+def native():
+    with mock.patch.object(openstack.NativeTransport, "_create_session"):
+        creds = {"region": "region"}
+        yield openstack.NativeTransport(creds, fallback=mock.Mock())
+
+
+def _response(body):
+    return mock.Mock(status_code=200, content=b"{}", json=mock.Mock(return_value=body))
+
+
+def test_native_transport_run(native):
+    request = native.session.request
+    request.return_value = _response(
+        {"subnets": [{"id": "id", "name": "a", "network_id": "n", "cidr": "c"}]}
+    )
+    assert native.run("openstack", ("subnet", "list")) == [
+        {"ID": "id", "Name": "a", "Network": "n", "Subnet": "c"}
+    ]
+    request.assert_called_once_with(
+        "/v2.0/subnets",
+        "GET",
+        endpoint_filter={
+            "service_type": "network",
+            "interface": "public",
+            "region_name": "region",
+        },
+        params=None,
+    )
+    native.fallback.run.assert_not_called()
+
+    assert (
+        native.run(
+            "openstack",
+            ("subnet", "show", "a", "-c", "network_id", "-f", "value"),
+            yaml_output=False,
+        )
+        == "n"
+    )
+
+    request.reset_mock()
+    request.side_effect = [
+        _response({"pools": [{"id": "pool-id", "name": "lb"}]}),
+        _response({"members": []}),
+    ]
+    assert native.run("neutron", ("lbaas-member-list", "lb")) == []
+    assert request.call_args_list[0][0][0] == "/v2.0/lbaas/pools"
+    assert request.call_args_list[0][1]["params"] == {"name": "lb"}
+    assert request.call_args_list[1][0][0] == "/v2.0/lbaas/pools/pool-id/members"
+
+    fallback_result = native.fallback.run.return_value
+    assert native.run("openstack", ("server", "list")) is fallback_result
+    native.fallback.run.assert_called_with("openstack", ("server", "list"), True)
+
+
+def test_native_transport_filters(native):
+    request = native.session.request
+    request.side_effect = [
+        _response({"loadbalancers": [{"id": "lb-id", "name": "lb"}]}),
+        _response({"listeners": [{"id": "listener-id", "name": "lb"}]}),
+        _response({"floatingips": []}),
+    ]
+    listeners = native.run(
+        "openstack", ("loadbalancer", "listener", "list", "--loadbalancer", "lb")
+    )
+    assert listeners == [{"id": "listener-id", "name": "lb"}]
+    assert request.call_args_list[1][0][0] == "/v2/lbaas/listeners"
+    assert request.call_args_list[1][1]["params"] == {"loadbalancer_id": "lb-id"}
+
+    native.run("openstack", ("floating", "ip", "list", "--port", "port-id"))
+    assert request.call_args[1]["params"] == {"port_id": "port-id"}
+
+
+def test_native_transport_error(native):
+    from keystoneauth1 import exceptions
+
+    native.session.request.side_effect = exceptions.NotFound()
+    with pytest.raises(MockCalledProcessError) as excinfo:
+        native.run("openstack", ("port", "show", "port-id"))
+    assert b"Not Found" in excinfo.value.stderr
+
+
+@mock.patch.object(openstack, "NativeTransport")
+def test_get_transport(native_transport, _load_creds):
+    _load_creds.return_value = {"region": "region"}
+    openstack._transport_for.cache_clear()
+    openstack.hookenv.config.return_value = {"api-transport": "native"}
+    assert openstack._get_transport() is native_transport.return_value
+    assert openstack._get_transport() is native_transport.return_value
+    native_transport.assert_called_once_with({"region": "region"})
+
+    openstack.hookenv.config.return_value = {"api-transport": "cli"}
+    assert isinstance(openstack._get_transport(), openstack.CLITransport)
+
+    native_transport.side_effect = ImportError
+    openstack.hookenv.config.return_value = {"api-transport": "native"}
+    assert isinstance(openstack._get_transport(), openstack.CLITransport)
+
+
+def test_find_secgrp(_openstack):
+    octavia = openstack.OctaviaLBImpl("lb", "443", "subnet", "alg", None, False)
+    _openstack.return_value = {"id": "sg-id", "name": "sg"}
+    assert octavia.find_secgrp("sg") == "sg-id"
+    _openstack.assert_called_once_with("security", "group", "show", "sg")
+
+    not_found = subprocess.CalledProcessError(1, "cmd")
+    not_found.stderr = b"No SecurityGroup found for sg"
+    _openstack.side_effect = not_found
+    assert octavia.find_secgrp("sg") is None
+
+    error = subprocess.CalledProcessError(1, "cmd")
+    error.stderr = b"Unauthorized"
+    _openstack.side_effect = error
+    with pytest.raises(subprocess.CalledProcessError):
+        octavia.find_secgrp("sg")
+
+    # admin credentials see groups of the same name in other projects
+    conflict = subprocess.CalledProcessError(1, "cmd")
+    conflict.stderr = b"More than one SecurityGroup exists with the name 'sg'"
+    _openstack.side_effect = [
+        conflict,
+        [{"ID": "other-id", "Name": "other"}, {"ID": "sg-id", "Name": "sg"}],
+    ]
+    with mock.patch.object(openstack, "_project_id", return_value="project-id"):
+        assert octavia.find_secgrp("sg") == "sg-id"
+    _openstack.assert_called_with(
+        "security", "group", "list", "--project", "project-id"
+    )
+
+
+def test_native_secgrp_show(native):
+    native.session.get_project_id.return_value = "project-id"
+    native.session.request.return_value = _response(
+        {"security_groups": [{"id": "sg-id", "name": "default"}]}
+    )
+    result = native.run("openstack", ("security", "group", "show", "default"))
+    assert result["id"] == "sg-id"
+    # the name is only looked up in the project of the credentials
+    assert native.session.request.call_args.kwargs["params"] == {
+        "project_id": "project-id",
+        "name": "default",
+    }
+
+
+@mock.patch.object(openstack, "_keystone_token")
+def test_project_id(_keystone_token, _load_creds):
+    _load_creds.return_value = {"project_id": "project-id"}
+    assert openstack._project_id() == "project-id"
+    _keystone_token.assert_not_called()
+
+    # otherwise it's the project the cached token is scoped to
+    _load_creds.return_value = {"project_id": ""}
+    auth_state = {"body": {"token": {"project": {"id": "token-project-id"}}}}
+    with mock.patch.object(
+        openstack, "_load_token", return_value={"auth_state": json.dumps(auth_state)}
+    ):
+        assert openstack._project_id() == "token-project-id"
+    with mock.patch.object(openstack, "_load_token", return_value=None):
+        assert openstack._project_id() is None
+
+
+def test_list_subnet_ports(_openstack):
+    octavia = openstack.OctaviaLBImpl("lb", "443", "subnet", "alg", None, False)
+    _openstack.return_value = [
+        {
+            "ID": "port-1",
+            "Fixed IP Addresses": [
+                {"subnet_id": "subnet-id", "ip_address": "10.0.0.1"},
+                {"subnet_id": "subnet-id", "ip_address": "10.0.0.2"},
+            ],
+            "Security Groups": ["sg-1"],
+        },
+        {
+            "ID": "port-3",
+            "Fixed IP Addresses": [
+                {"subnet_id": "subnet-id", "ip_address": "10.0.0.3"}
+            ],
+            "Security Groups": [],
+        },
+    ]
+    assert octavia.list_subnet_ports() == {
+        "10.0.0.1": {"id": "port-1", "security_groups": ["sg-1"]},
+        "10.0.0.2": {"id": "port-1", "security_groups": ["sg-1"]},
+        "10.0.0.3": {"id": "port-3", "security_groups": []},
+    }
+    _openstack.assert_called_once_with(
+        "port", "list", "--fixed-ip", "subnet=subnet", "--long"
+    )
+
+
+def test_octavia_list_healthmonitors(_openstack):
+    octavia = openstack.OctaviaLBImpl("lb", "443", "subnet", "alg", None, False)
+    _openstack.side_effect = [{"healthmonitor_id": None}]
+    assert octavia.list_healthmonitors() == []
+
+    _openstack.side_effect = [{"healthmonitor_id": "hm-id"}, {"name": "lb"}]
+    assert octavia.list_healthmonitors() == [{"name": "lb"}]
+    _openstack.assert_called_with("loadbalancer", "healthmonitor", "show", "hm-id")
+
+
+@mock.patch.object(openstack, "_get_transport")
+def test_read_cache(_get_transport):
+    run = _get_transport.return_value.run
+    run.side_effect = lambda cli, args, yaml_output=True: [{"args": args}]
+    stats = openstack.read_cache_stats()
+
+    sgs = openstack._openstack("security", "group", "list")
+    sgs[0]["args"] = "modified by caller"
+    assert openstack._openstack("security", "group", "list") == [
+        {"args": ("security", "group", "list")}
+    ]
+    openstack._openstack("security", "group", "rule", "list", "sg")
+    openstack._openstack("subnet", "show", "subnet")
+    assert run.call_count == 3
+    assert openstack.read_cache_stats() == {
+        "hits": stats["hits"] + 1,
+        "misses": stats["misses"] + 3,
+    }
+
+    # changes drop the results for that type of resource, and those nested in it
+    openstack._openstack("security", "group", "create", "sg")
+    openstack._openstack("security", "group", "list")
+    openstack._openstack("security", "group", "rule", "list", "sg")
+    openstack._openstack("subnet", "show", "subnet")
+    assert run.call_count == 6
+
+    # LB resources are never cached, so waits see their latest status
+    run.reset_mock()
+    openstack._openstack("loadbalancer", "show", "lb")
+    openstack._openstack("loadbalancer", "show", "lb")
+    openstack._neutron("lbaas-pool-show", "lb")
+    openstack._neutron("lbaas-pool-show", "lb")
+    assert run.call_count == 4
+
+    # even failed changes drop the results
+    run.reset_mock()
+    run.side_effect = [[], subprocess.CalledProcessError(1, "cmd"), []]
+    openstack._openstack("port", "list")
+    with pytest.raises(subprocess.CalledProcessError):
+        openstack._openstack("port", "set", "port", yaml_output=False)
+    openstack._openstack("port", "list")
+    assert run.call_count == 3
+
+
+CATALOG = [
+    {
+        "Name": "octavia",
+        "Type": "load-balancer",
+        "Endpoints": [
+            {"region": "other", "interface": "public", "url": "https://other"},
+            {"region": "region", "interface": "public", "url": "https://lb"},
+        ],
+    },
+    {
+        "Name": "cinderv3",
+        "Type": "volumev3",
+        "Endpoints": [{"region": "other", "interface": "public", "url": "https://v"}],
+    },
+]
+
+
+def test_service_catalog():
+    catalog = openstack.ServiceCatalog(CATALOG, "region")
+    assert catalog.has_service(name="octavia")
+    assert catalog.has_service(service_type="load-balancer")
+    assert not catalog.has_service(service_type="volumev3")
+    assert catalog.endpoint("load-balancer") == "https://lb"
+    assert catalog.endpoint("load-balancer", interface="internal") is None
+    assert openstack.ServiceCatalog(CATALOG, "other").endpoint("volumev3")
+
+
+def test_get_catalog(_openstack, _load_creds, kv):
+    _load_creds.return_value = {"auth_url": "auth_url", "region": "region"}
+    openstack.hookenv.config.return_value = {"catalog-cache-ttl": 60}
+    openstack._cached_catalog.cache_clear()
+    kv().get.return_value = None
+    _openstack.return_value = CATALOG
+    assert openstack.detect_octavia() is True
+    assert openstack.get_catalog().has_service(name="octavia")
+    _openstack.assert_called_once_with("catalog", "list")
+    kv().set.assert_called_once_with(
+        "charm.openstack.catalog",
+        {"key": "auth_url|region", "fetched_at": mock.ANY, "catalog": CATALOG},
+    )
+
+    # served from unitdata by a later hook
+    openstack._cached_catalog.cache_clear()
+    _openstack.reset_mock()
+    kv().get.return_value = kv().set.call_args[0][1]
+    assert openstack.get_catalog().has_service(name="octavia")
+    _openstack.assert_not_called()
+
+    # unless it's expired or being refreshed
+    openstack._cached_catalog.cache_clear()
+    kv().get.return_value["fetched_at"] -= 120
+    _openstack.return_value = CATALOG[1:]
+    assert openstack.detect_octavia() is False
+    _openstack.assert_called_once_with("catalog", "list")
+    openstack.get_catalog(refresh=True)
+    kv().unset.assert_called_with("charm.openstack.catalog")
+    assert _openstack.call_count == 2
+
+    openstack._cached_catalog.cache_clear()
+    kv().get.return_value = None
+    _openstack.side_effect = MockCalledProcessError(1, b"")
+    assert openstack.detect_octavia() is False
+
+
+def test_default_subnet(_openstack, _load_creds):
+    _load_creds.return_value = {"auth_url": "auth", "region": "region"}
     members = [("192.168.0.1", 80), ("10.0.0.1", 80)]
     endpoint = "unused"
     _openstack.return_value = [
@@ -262,6 +769,47 @@ def test_default_subnet(_openstack):
     assert openstack._default_subnet(list(reversed(members)), endpoint) == "b"
     with pytest.raises(openstack.OpenStackLBError):
         openstack._default_subnet([("10.1.0.1", 80)], endpoint)
+    members = [("10.0.0.1", 80), ("192.168.0.1", 80), ("192.168.0.2", 80)]
+    assert openstack._default_subnet(members, endpoint) == "a"
+    _openstack.assert_called_once_with("subnet", "list")
+
+
+def test_subnet_index():
+    index = openstack.SubnetIndex(
+        [
+            {"Name": "wide", "Subnet": "10.0.0.0/8"},
+            {"Name": "narrow", "Subnet": "10.1.2.0/24"},
+            {"Name": "v6", "Subnet": "2001:db8::/64"},
+            {"Name": "v6-wide", "Subnet": "2001:db8::/32"},
+        ]
+    )
+    assert index.lookup("10.1.2.3") == "narrow"
+    assert index.lookup("10.1.3.3") == "wide"
+    assert index.lookup("2001:db8::1") == "v6"
+    assert index.lookup("2001:db8:1::1") == "v6-wide"
+    assert index.lookup("192.168.0.1") is None
+    assert index.lookup("::ffff:10.1.2.3") is None
+
+
+def test_resolve_subnets(_openstack, _load_creds):
+    _load_creds.return_value = {"auth_url": "auth", "region": "region"}
+    openstack.hookenv.config.return_value = {"subnet-cache-ttl": 3600}
+    _openstack.return_value = [{"Name": "a", "Subnet": "10.0.0.0/24"}]
+    assert openstack.resolve_subnets(["10.0.0.1", "10.0.0.2"]) == {
+        "10.0.0.1": "a",
+        "10.0.0.2": "a",
+    }
+    # the index is only listed once per hook, even on a miss
+    assert openstack.resolve_subnets(["10.0.1.1"]) == {"10.0.1.1": None}
+    _openstack.assert_called_once_with("subnet", "list")
+
+    # in later hooks, the persisted index is refreshed on a miss
+    openstack._cached_subnet_index.cache_clear()
+    _openstack.return_value.append({"Name": "b", "Subnet": "10.0.1.0/24"})
+    assert openstack.resolve_subnets(["10.0.0.1"]) == {"10.0.0.1": "a"}
+    assert _openstack.call_count == 1
+    assert openstack.resolve_subnets(["10.0.1.1"]) == {"10.0.1.1": "b"}
+    assert _openstack.call_count == 2
 
 
 @mock.patch.object(openstack, "_default_subnet")
@@ -286,15 +834,57 @@ def test_manage_loadbalancer(mock_lb, mock_subnet):
     )
     mock_subnet.assert_called_once_with(members, "lb-consumers")
     mock_lb.get_or_create.assert_called_once_with(
-        "my-ha-app", lb_port, mock_subnet.return_value, lb_method, "fip-network", False
+        "my-ha-app",
+        lb_port,
+        mock_subnet.return_value,
+        lb_method,
+        "fip-network",
+        False,
+        [("1.2.3.4", "80")],
+        False,
     )
     lb_manager.update_members.assert_called_once_with([("1.2.3.4", "80")])
+    assert lb_manager.inputs_hash == openstack._lb_inputs_hash(
+        members, lb_port, lb_method
+    )
+    lb_manager._update_cached_info.assert_called_once_with()
+
+
+def test_get_unchanged_loadbalancer(kv):
+    openstack.hookenv.config.return_value = {
+        "lb-subnet": "",
+        "lb-floating-network": "fip-network",
+        "manage-security-groups": False,
+    }
+    members = [("1.2.3.4", 80), ("1.2.3.5", "80")]
+    info = {
+        "fip": "8.8.8.8",
+        "inputs_hash": openstack._lb_inputs_hash(members, 443, "ROUND_ROBIN"),
+    }
+    kv().get.return_value = info
+    args = ("my-app", list(reversed(members)), "443", "ROUND_ROBIN")
+    assert openstack.get_unchanged_loadbalancer(*args) is info
+    kv().get.assert_called_once_with(
+        "created_lbs.openstack-integrator-{}-my-app".format(openstack.MODEL_SHORT_ID)
+    )
+    assert (
+        openstack.get_unchanged_loadbalancer("my-app", members[:1], 443, "ROUND_ROBIN")
+        is None
+    )
+    assert (
+        openstack.get_unchanged_loadbalancer("my-app", members, 443, "SOURCE_IP")
+        is None
+    )
+    openstack.hookenv.config.return_value["manage-security-groups"] = True
+    assert openstack.get_unchanged_loadbalancer(*args) is None
+    kv().get.return_value = None
+    assert openstack.get_unchanged_loadbalancer(*args) is None
 
 
-@mock.patch.object(openstack.LoadBalancer, "_add_member_sg")
+@mock.patch.object(openstack.LoadBalancer, "_secure_members")
 @mock.patch.object(openstack.LoadBalancer, "_create_member_sg")
 @mock.patch.object(openstack.LoadBalancer, "create")
-def test_get_or_create(create, cms, ams, kv):
+def test_get_or_create(create, cms, sm, kv):
     args = ("app", "80", "subnet", "alg", None, False)
     kv().get.return_value = {
         "sg_id": "sg_id",
@@ -319,16 +909,15 @@ def test_get_or_create(create, cms, ams, kv):
     assert lb.members == {(1, 2), (3, 4)}
     assert lb.is_created is True
     cms.assert_not_called()
-    ams.assert_not_called()
+    sm.assert_not_called()
 
     del kv().get.return_value["member_sg_id"]
     lb = openstack.LoadBalancer.get_or_create(*args)
     cms.assert_called_once()
-    ams.assert_any_call((1, 2), raise_on_err=False)
-    ams.assert_any_call((3, 4), raise_on_err=False)
+    sm.assert_called_once_with({(1, 2), (3, 4)})
 
     cms.reset_mock()
-    ams.reset_mock()
+    sm.reset_mock()
     kv().get.return_value = None
     lb = openstack.LoadBalancer.get_or_create(*args)
     create.assert_called_once()
@@ -337,7 +926,7 @@ def test_get_or_create(create, cms, ams, kv):
     assert lb.address is None
     assert lb.members == set()
     cms.assert_not_called()
-    ams.assert_not_called()
+    sm.assert_not_called()
 
     create.side_effect = subprocess.CalledProcessError(1, "cmd")
     with pytest.raises(openstack.OpenStackLBError):
@@ -407,6 +996,79 @@ def test_create_new(impl, log_err, kv):
     impl.create_fip.assert_called_with("1.1.1.1", "4321")
 
 
+def test_create_populated(impl, kv):
+    kv().get.return_value = None
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
+    name = "openstack-integrator-1234-app"
+    members = {("1.2.3.4", "6443"), ("1.2.3.5", "6443")}
+    impl.list_loadbalancers.return_value = []
+    impl.create_populated_loadbalancer.side_effect = None
+    impl.create_populated_loadbalancer.return_value = {
+        "id": "1234",
+        "vip_address": "1.1.1.1",
+        "vip_port_id": "4321",
+    }
+    impl.show_loadbalancer.return_value = {"provisioning_status": "ACTIVE"}
+    impl.find_secgrp.side_effect = ["sg_id", "member_sg_id"]
+    impl.list_sg_rules.return_value = []
+    impl.get_port_sec_enabled.return_value = True
+    impl.list_listeners.return_value = [{"name": name}]
+    impl.list_pools.return_value = [{"name": name}]
+    impl.list_healthmonitors.return_value = [{"name": name}]
+    impl.list_members.return_value = set(members)
+    impl.list_subnet_ports.return_value = {
+        "1.2.3.4": {"id": "port-4", "security_groups": ["member_sg_id"]},
+        "1.2.3.5": {"id": "port-5", "security_groups": []},
+    }
+    impl.set_port_secgrp.side_effect = subprocess.CalledProcessError(1, "cmd")
+    impl.get_subnet_cidr.return_value = "1.2.3.0/24"
+    openstack.hookenv.config.return_value = {"lb-member-concurrency": 2}
+    lb.create(members)
+    impl.create_populated_loadbalancer.assert_called_once_with(members)
+    impl.create_loadbalancer.assert_not_called()
+    impl.create_listener.assert_not_called()
+    impl.create_pool.assert_not_called()
+    impl.create_healthmonitor.assert_not_called()
+    impl.show_loadbalancer.assert_called_once()
+    impl.set_port_secgrp.assert_called_once_with("port-5", "member_sg_id")
+    # the member which couldn't be secured is left for update_members
+    assert lb.members == {("1.2.3.4", "6443")}
+    assert lb.address == "1.1.1.1"
+
+
+def test_octavia_create_populated(native):
+    with mock.patch.object(openstack, "_get_transport", return_value=native):
+        octavia = openstack.OctaviaLBImpl("lb", "443", "subnet", "alg", None, False)
+        native.session.request.side_effect = [
+            _response({"subnets": [{"id": "subnet-id"}]}),
+            _response({"loadbalancer": {"id": "lb-id", "vip_address": "1.1.1.1"}}),
+        ]
+        lb_info = octavia.create_populated_loadbalancer({("1.1.1.2", "6443")})
+    assert lb_info == {"id": "lb-id", "vip_address": "1.1.1.1"}
+    path, method = native.session.request.call_args[0]
+    assert (path, method) == ("/v2/lbaas/loadbalancers", "POST")
+    body = native.session.request.call_args[1]["json"]["loadbalancer"]
+    assert body["vip_subnet_id"] == "subnet-id"
+    (listener,) = body["listeners"]
+    assert listener["protocol_port"] == 443
+    pool = listener["default_pool"]
+    assert pool["lb_algorithm"] == "alg"
+    assert pool["members"] == [
+        {
+            "name": "1.1.1.2",
+            "address": "1.1.1.2",
+            "protocol_port": 6443,
+            "subnet_id": "subnet-id",
+        }
+    ]
+    assert pool["healthmonitor"]["type"] == "TLS-HELLO"
+
+    cli = openstack.CLITransport()
+    with mock.patch.object(openstack, "_get_transport", return_value=cli):
+        with pytest.raises(NotImplementedError):
+            octavia.create_populated_loadbalancer(set())
+
+
 def test_create_recover(impl, kv):
     kv().get.return_value = None
     lb = openstack.LoadBalancer("app", "80", "subnet", "alg", "net", True)
@@ -475,17 +1137,263 @@ def test_load_from_cache(impl, kv):
     impl.find_secgrp.assert_called_with("openstack-integrator-1234-app-members")
 
 
-def test_delete_loadbalancer(impl, kv):
-    kv().get.return_value = None
-    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", "net", True)
-    lb.delete()
+def test_port_security_enabled(_openstack):
+    openstack.hookenv.config.return_value = {"port-security-cache-ttl": 3600}
+    openstack.clear_port_security_cache()
+    _openstack.side_effect = [
+        {"network_id": "net-id"},
+        {"port_security_enabled": True},
+        {"network_id": "net-id"},
+    ]
+    assert openstack.port_security_enabled("subnet") is True
+    assert openstack.port_security_enabled("subnet") is True
+    assert _openstack.call_count == 2
+    # the network is shared with other subnets
+    assert openstack.port_security_enabled("other-subnet") is True
+    _openstack.assert_called_with("subnet", "show", "other-subnet")
+
+    openstack.clear_port_security_cache()
+    _openstack.side_effect = [
+        {"network_id": "net-id"},
+        {"port_security_enabled": False},
+    ]
+    assert openstack.port_security_enabled("subnet") is False
+    openstack.clear_port_security_cache()
+
+
+def test_load_balancer_no_probe(impl, kv):
+    kv().get.return_value = {
+        "sg_id": None,
+        "member_sg_id": "member_sg_id",
+        "fip": None,
+        "address": "1.1.1.1",
+        "members": [],
+    }
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
+    impl.get_port_sec_enabled.assert_not_called()
+    impl.get_port_sec_enabled.return_value = False
+    assert lb.is_port_sec_enabled is False
+    assert lb.is_port_sec_enabled is False
+    impl.get_port_sec_enabled.assert_called_once()
 
+    # LBs on networks without port security never get a member SG
+    impl.get_port_sec_enabled.reset_mock()
+    kv().get.return_value["member_sg_id"] = None
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
+    impl.get_port_sec_enabled.assert_not_called()
+    assert lb.member_sg_id is None
+
+    # LBs from before the member SG are probed once, and then saved
+    del kv().get.return_value["member_sg_id"]
+    kv().set.reset_mock()
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
     impl.get_port_sec_enabled.assert_called_once()
-    impl.delete_loadbalancer.assert_called_once()
-    openstack.kv().unset.assert_called_with("created_lbs.openstack-integrator-1234-app")
+    impl.create_secgrp.assert_not_called()
+    assert kv().set.call_args.args[1]["member_sg_id"] is None
+
+
+@mock.patch.object(openstack.LoadBalancer, "create")
+def test_load_balancer_refresh(create, impl, kv):
+    kv().get.return_value = {
+        "sg_id": None,
+        "member_sg_id": None,
+        "fip": None,
+        "address": "1.1.1.1",
+        "members": [["1.1.1.2", "80"]],
+    }
+    args = ("app", "80", "subnet", "alg", None, False, [("1.1.1.3", "80")])
+    impl.list_members.return_value = {("1.1.1.4", "80")}
+
+    # the cached state is trusted unless asked to refresh it
+    lb = openstack.LoadBalancer.get_or_create(*args)
+    impl.show_loadbalancer.assert_not_called()
+    assert lb.members == {("1.1.1.2", "80")}
+
+    # members changed out of band are found
+    lb = openstack.LoadBalancer.get_or_create(*args, refresh=True)
+    impl.show_loadbalancer.assert_called_once()
+    assert lb.members == {("1.1.1.4", "80")}
+    create.assert_not_called()
+
+    # and a deleted LB is created again
+    gone = MockCalledProcessError(1, "cmd")
+    gone.stderr = b"Unable to locate openstack-integrator-1234-app in loadbalancers"
+    impl.show_loadbalancer.side_effect = gone
+    openstack.LoadBalancer.get_or_create(*args, refresh=True)
+    create.assert_called_once_with([("1.1.1.3", "80")])
+
+    error = MockCalledProcessError(1, "cmd")
+    error.stderr = b"Internal Server Error"
+    impl.show_loadbalancer.side_effect = error
+    with pytest.raises(openstack.OpenStackLBError):
+        openstack.LoadBalancer.get_or_create(*args, refresh=True)
+
+
+def test_delete_loadbalancers(impl, kv, clock):
+    kv().get.return_value = None
+    names = ["openstack-integrator-1234-app{}".format(i) for i in range(4)]
+    cached_lbs = [
+        {
+            "app_name": "app{}".format(i),
+            "port": "80",
+            "subnet": "subnet",
+            "algorithm": "alg",
+            "fip_net": None,
+            "manage_secgrps": False,
+        }
+        for i in range(4)
+    ]
+    failure = MockCalledProcessError(1, "cmd")
+    failure.stderr = b"Internal Server Error"
+    gone = MockCalledProcessError(1, "cmd")
+    gone.stderr = b"No loadbalancer found for app2"
+    impl.delete_loadbalancer.side_effect = [None, failure, gone, None]
+    # app0 goes quickly, app3 never goes
+    impl.list_loadbalancers.side_effect = [
+        [{"name": names[0]}, {"name": names[3]}],
+        [{"name": names[3]}],
+        [{"name": names[3]}],
+    ] + [[{"name": names[3]}]] * 100
+
+    deleted, pending, failed = openstack.delete_loadbalancers(cached_lbs, 1, 20)
+    assert sorted(deleted) == [names[0], names[2]]
+    assert pending == [names[3]]
+    assert failed == [names[1]]
+    assert impl.delete_loadbalancer.call_count == 4
+    # deleting doesn't need to probe for port security
+    impl.get_port_sec_enabled.assert_not_called()
+    # all LBs are polled together, within the deadline
+    assert openstack.monotonic() >= 20
+    assert impl.list_loadbalancers.call_count < 10
+    removed = [c.args[0] for c in kv().unset.call_args_list]
+    assert sorted(removed) == ["created_lbs." + names[0], "created_lbs." + names[2]]
+
+
+def test_delete_loadbalancers_deadline(impl, kv, clock):
+    kv().get.return_value = None
+    names = ["openstack-integrator-1234-app{}".format(i) for i in range(3)]
+    cached_lbs = [
+        {
+            "app_name": "app{}".format(i),
+            "port": "80",
+            "subnet": "subnet",
+            "algorithm": "alg",
+            "fip_net": None,
+            "manage_secgrps": False,
+        }
+        for i in range(3)
+    ]
+    gone = MockCalledProcessError(1, "cmd")
+    gone.stderr = b"Unable to locate openstack-integrator-1234-app0 in loadbalancers"
+
+    def delete_loadbalancer(deadline):
+        if impl.delete_loadbalancer.call_count == 1:
+            raise gone
+        openstack.sleep(deadline - openstack.monotonic())
+        raise TimeoutError("Timed out deleting app1 in PENDING_UPDATE")
+
+    impl.delete_loadbalancer.side_effect = delete_loadbalancer
+    impl.list_loadbalancers.return_value = [{"name": names[1]}, {"name": names[2]}]
+
+    deleted, pending, failed = openstack.delete_loadbalancers(cached_lbs, 1, 20)
+    # an LB the Octavia CLI can't find is already gone
+    assert deleted == [names[0]]
+    # the deletes still waiting at the deadline are abandoned, and the rest
+    # aren't started
+    assert pending == [names[1], names[2]]
+    assert failed == []
+    assert impl.delete_loadbalancer.call_count == 2
+    impl.delete_loadbalancer.assert_called_with(deadline=20)
+    assert openstack.monotonic() == 20
+
+
+def test_neutron_delete_loadbalancer(_neutron, _openstack, clock):
+    openstack.hookenv.config.return_value = {
+        "lb-member-concurrency": 4,
+        "lb-wait-timeout": 60,
+    }
+    neutron = openstack.NeutronLBImpl("lb", "443", "subnet", "alg", "ext-net", True)
+    gone = MockCalledProcessError(1, "cmd")
+    gone.stderr = b"Unable to find loadbalancer with name or id 'lb'"
+    shows = iter(
+        [
+            {"vip_port_id": "vip-port", "provisioning_status": "ACTIVE"},
+            {"provisioning_status": "PENDING_UPDATE"},
+            {"provisioning_status": "ACTIVE"},
+            {"provisioning_status": "ACTIVE"},
+            {"provisioning_status": "PENDING_DELETE"},
+            gone,
+        ]
+    )
+
+    def neutron_cmd(cmd, *args):
+        if cmd == "lbaas-loadbalancer-show":
+            show = next(shows)
+            if isinstance(show, Exception):
+                raise show
+            return show
+        if cmd in ("lbaas-pool-list", "lbaas-listener-list"):
+            return [{"name": "lb"}]
+
+    _neutron.side_effect = neutron_cmd
+    _openstack.side_effect = lambda *args, **kwargs: (
+        [{"Floating IP Address": "8.8.8.{}".format(i)} for i in range(3)]
+        if args[:3] == ("floating", "ip", "list")
+        else {"id": "sg-id"}
+    )
+    neutron.delete_loadbalancer()
+
+    # only the FIPs of the VIP port are deleted
+    _openstack.assert_any_call(
+        "floating", "ip", "list", "--network", "ext-net", "--port", "vip-port"
+    )
+    deleted_fips = {
+        c.args[3]
+        for c in _openstack.call_args_list
+        if c.args[:3] == ("floating", "ip", "delete")
+    }
+    assert deleted_fips == {"8.8.8.0", "8.8.8.1", "8.8.8.2"}
+    # members go with the pool, and the LB is only waited on when needed
+    assert [c.args[0] for c in _neutron.call_args_list] == [
+        "lbaas-loadbalancer-show",
+        "lbaas-pool-list",
+        "lbaas-pool-delete",
+        "lbaas-loadbalancer-show",
+        "lbaas-loadbalancer-show",
+        "lbaas-listener-list",
+        "lbaas-listener-delete",
+        "lbaas-loadbalancer-show",
+        "lbaas-loadbalancer-delete",
+        "lbaas-loadbalancer-show",
+        "lbaas-loadbalancer-show",
+    ]
+    # the security group is deleted once the VIP port is gone
+    _openstack.assert_called_with("security", "group", "delete", "sg-id")
+
+    # waits don't go past the teardown deadline
+    _neutron.side_effect = None
+    _neutron.return_value = {"provisioning_status": "PENDING_UPDATE"}
+    now = openstack.monotonic()
+    with pytest.raises(TimeoutError):
+        neutron._wait_lb(deadline=now + 10)
+    assert openstack.monotonic() == now + 10
+
+
+@pytest.fixture
+def clock():
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
 
+    with mock.patch.object(openstack, "monotonic", lambda: now[0]), mock.patch.object(
+        openstack, "sleep", side_effect=sleep
+    ) as _sleep:
+        yield _sleep
 
-def test_wait_not_pending(impl):
+
+def test_wait_not_pending(impl, clock):
+    openstack.hookenv.config.return_value = {"lb-wait-timeout": 60}
     lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
     test_func = mock.Mock(
         side_effect=[
@@ -495,10 +1403,15 @@ def test_wait_not_pending(impl):
             {"provisioning_status": "ACTIVE"},
         ]
     )
-    with mock.patch.object(openstack, "sleep") as sleep:
-        lb._wait_not_pending(test_func)
-    assert sleep.call_count == 3
-
+    lb._wait_not_pending(test_func)
+    assert clock.call_count == 3
+    # backs off exponentially, with jitter, from a short first interval
+    intervals = [call.args[0] for call in clock.call_args_list]
+    assert 0.25 <= intervals[0] <= 0.5
+    assert 0.5 <= intervals[1] <= 1.0
+    assert 1.0 <= intervals[2] <= 2.0
+
+    clock.reset_mock()
     test_func = mock.Mock(
         return_value={
             "provisioning_status": "PENDING_DELETE",
@@ -506,6 +1419,9 @@ def test_wait_not_pending(impl):
     )
     with pytest.raises(openstack.OpenStackLBError):
         lb._wait_not_pending(test_func)
+    # gives up at the deadline rather than after a number of retries
+    assert sum(call.args[0] for call in clock.call_args_list) == pytest.approx(60)
+    assert max(call.args[0] for call in clock.call_args_list) <= 10
 
 
 def test_find_matching_sg_rule(impl):
@@ -515,21 +1431,34 @@ def test_find_matching_sg_rule(impl):
     impl.list_sg_rules.return_value = [{"Port Range": None, "IP Range": None}]
     assert lb._find_matching_sg_rule("sg_id", lb.address, lb.port)
 
+    openstack._sg_rule_indexes.clear()
     impl.list_sg_rules.return_value = [{"Port Range": "60:90", "IP Range": ""}]
     assert lb._find_matching_sg_rule("sg_id", lb.address, lb.port)
 
+    openstack._sg_rule_indexes.clear()
     impl.list_sg_rules.return_value = [{"Port Range": "", "IP Range": "1.0.0.0/8"}]
     assert lb._find_matching_sg_rule("sg_id", lb.address, lb.port)
 
+    openstack._sg_rule_indexes.clear()
     impl.list_sg_rules.return_value = [
         {"Port Range": "81:90", "IP Range": ""},
         {"Port Range": "", "IP Range": "2.0.0.0/8"},
     ]
     assert not lb._find_matching_sg_rule("sg_id", lb.address, lb.port)
 
+    openstack._sg_rule_indexes.clear()
+    impl.list_sg_rules.reset_mock()
     impl.list_sg_rules.return_value = []
     assert not lb._find_matching_sg_rule("sg_id", lb.address, lb.port)
 
+    # the rules are listed once, and rules which are created are added
+    lb._create_sg_rule("sg_id", "1.1.1.0/24", "80")
+    impl.create_sg_rule.assert_called_once_with("sg_id", "1.1.1.0/24", "80")
+    assert lb._find_matching_sg_rule("sg_id", lb.address, lb.port)
+    assert not lb._find_matching_sg_rule("sg_id", "1.1.2.1", lb.port)
+    assert not lb._find_matching_sg_rule("sg_id", lb.address, "81")
+    impl.list_sg_rules.assert_called_once_with("sg_id")
+
 
 def test_find(impl, log_err):
     lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
@@ -545,14 +1474,59 @@ def test_find(impl, log_err):
     )
 
 
-def test_member_sg_failure(impl, _openstack):
-    impl.find_port.return_value = None
+def test_member_sg_failure(impl, _openstack, kv):
+    kv().get.return_value = None
+    impl.list_subnet_ports.return_value = {}
     lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
     lb.address = "1.1.1.1"
     lb.members = {(1, 2)}
     with pytest.raises(openstack.OpenStackLBError) as excinfo:
         lb.update_members({(1, 2), (3, 4)})
     assert "Error while member-adding load balancer" in str(excinfo.value)
+    assert "failed members: 3:4" in str(excinfo.value)
+    impl.create_member.assert_not_called()
+    assert lb.members == {(1, 2)}
+
+
+def test_member_sg_ledger(impl, kv):
+    kv().get.return_value = None
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
+    lb.address = "1.1.1.1"
+    lb.member_sg_id = "member_sg_id"
+    impl.show_pool.return_value = {"provisioning_status": "ACTIVE"}
+    impl.list_sg_rules.return_value = []
+    impl.get_subnet_cidr.return_value = "1.1.1.0/24"
+    impl.list_subnet_ports.return_value = {
+        "10.0.0.1": {"id": "port-1", "security_groups": ["member_sg_id"]},
+        "10.0.0.2": {"id": "port-2", "security_groups": []},
+    }
+    lb.members = {("10.0.0.1", "80")}
+    lb.update_members({("10.0.0.1", "80"), ("10.0.0.2", "80")})
+    impl.set_port_secgrp.assert_called_once_with("port-2", "member_sg_id")
+    assert lb.member_sg_ports == {"10.0.0.2": "port-2"}
+    assert lb.member_sg_rules == {"80"}
+    cached = kv().set.call_args[0][1]
+    assert cached["member_sg_id"] == "member_sg_id"
+    assert cached["member_sg_ports"] == {"10.0.0.2": "port-2"}
+    assert cached["member_sg_rules"] == ["80"]
+
+    # members in the ledger don't need any API calls to secure
+    impl.list_subnet_ports.reset_mock()
+    impl.list_sg_rules.reset_mock()
+    assert lb._secure_members({("10.0.0.2", "80")}) == set()
+    impl.list_subnet_ports.assert_not_called()
+
+    # removed members are forgotten
+    lb.update_members({("10.0.0.1", "80")})
+    assert lb.member_sg_ports == {}
+
+    # a cached LB with a ledger isn't secured again when loaded
+    kv().get.return_value = dict(cached, members=[["10.0.0.2", "80"]])
+    impl.list_subnet_ports.reset_mock()
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
+    assert lb.member_sg_ports == {"10.0.0.2": "port-2"}
+    assert lb.member_sg_rules == {"80"}
+    impl.list_subnet_ports.assert_not_called()
 
 
 def test_update_members(impl, _openstack):
@@ -561,15 +1535,47 @@ def test_update_members(impl, _openstack):
     impl.show_pool.return_value = {"provisioning_status": "ACTIVE"}
     impl.list_sg_rules.return_value = []
     impl.get_subnet_cidr.return_value = "1.1.1.0/24"
+    ports = {
+        addr: {"id": f"port-{addr}", "security_groups": []} for addr in (1, 3, 5)
+    }
+    impl.list_subnet_ports.return_value = ports
+
+    def set_port_secgrp(port_id, sg_id):
+        for port in ports.values():
+            if port["id"] == port_id:
+                port["security_groups"].append(sg_id)
+
+    impl.set_port_secgrp.side_effect = set_port_secgrp
 
     lb.members = {(1, 2), (3, 4)}
     lb.update_members({(1, 2), (3, 4)})
     impl.delete_member.assert_not_called()
     impl.create_member.assert_not_called()
+    # the ports of unchanged members are still checked
+    assert impl.set_port_secgrp.call_count == 2
+    assert impl.create_sg_rule.call_count == 2
+
+    # a member rebuilt on a new port with the same address is secured again
+    impl.set_port_secgrp.reset_mock()
+    impl.create_sg_rule.reset_mock()
+    ports[1] = {"id": "new-port", "security_groups": []}
+    lb.update_members({(1, 2), (3, 4)})
+    impl.set_port_secgrp.assert_called_once_with("new-port", lb.member_sg_id)
+    assert lb.member_sg_ports[1] == "new-port"
     impl.create_sg_rule.assert_not_called()
 
+    # as are rules removed out of band, which a later hook finds missing
+    impl.set_port_secgrp.reset_mock()
+    openstack._sg_rule_indexes.clear()
+    lb.update_members({(1, 2), (3, 4)})
+    impl.set_port_secgrp.assert_not_called()
+    assert impl.create_sg_rule.call_count == 2
+
+    impl.set_port_secgrp.reset_mock()
+    impl.create_sg_rule.reset_mock()
     lb.members = {(1, 2), (3, 4)}
     lb.update_members({(1, 2), (3, 4), (5, 6)})
+    impl.set_port_secgrp.assert_called_once_with("port-5", lb.member_sg_id)
     impl.delete_member.assert_not_called()
     impl.create_member.assert_called_once()
     assert lb.members == {(1, 2), (3, 4), (5, 6)}
@@ -602,6 +1608,81 @@ def test_update_members(impl, _openstack):
         lb.update_members({(1, 2)})
 
 
+def test_update_members_partial_failure(impl, _openstack, kv):
+    kv().get.return_value = None
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
+    lb.address = "1.1.1.1"
+    lb.is_port_sec_enabled = False
+    impl.show_pool.return_value = {"provisioning_status": "ACTIVE"}
+
+    def create_member(member):
+        if member == (5, 6):
+            raise subprocess.CalledProcessError(1, "cmd")
+
+    impl.create_member.side_effect = create_member
+    lb.members = {(1, 2), (3, 4)}
+    with pytest.raises(openstack.OpenStackLBError) as excinfo:
+        lb.update_members({(1, 2), (5, 6), (7, 8)})
+    assert "failed members: 5:6" in str(excinfo.value)
+    impl.delete_member.assert_called_once_with((3, 4))
+    assert impl.create_member.call_count == 2
+    # wait between each change, then once for the final change to settle
+    assert impl.show_pool.call_count == 3
+    assert lb.members == {(1, 2), (7, 8)}
+    kv().set.assert_called_once()
+
+
+def test_update_members_batch(impl, _openstack, kv):
+    kv().get.return_value = None
+    lb = openstack.LoadBalancer("app", "80", "subnet", "alg", None, False)
+    lb.is_port_sec_enabled = False
+    impl.show_pool.return_value = {"provisioning_status": "ACTIVE"}
+    impl.replace_members.side_effect = None
+
+    lb.members = {(1, 2), (3, 4)}
+    lb.update_members({(1, 2), (5, 6), (7, 8)})
+    impl.replace_members.assert_called_once_with({(1, 2), (5, 6), (7, 8)})
+    impl.delete_member.assert_not_called()
+    impl.create_member.assert_not_called()
+    impl.show_pool.assert_called_once()
+    assert lb.members == {(1, 2), (5, 6), (7, 8)}
+
+    impl.replace_members.side_effect = subprocess.CalledProcessError(1, "cmd")
+    with pytest.raises(openstack.OpenStackLBError) as excinfo:
+        lb.update_members({(1, 2)})
+    assert "failed members: 5:6, 7:8" in str(excinfo.value)
+    assert lb.members == {(1, 2), (5, 6), (7, 8)}
+
+
+def test_octavia_replace_members(native):
+    with mock.patch.object(openstack, "_get_transport", return_value=native):
+        octavia = openstack.OctaviaLBImpl("lb", "443", "subnet", "alg", None, False)
+        native.session.request.side_effect = [
+            _response({"subnets": [{"id": "subnet-id"}]}),
+            _response({"pools": [{"id": "pool-id"}]}),
+            mock.Mock(status_code=202, content=b""),
+        ]
+        octavia.replace_members({("1.1.1.1", "6443"), ("1.1.1.2", "6443")})
+    path, method = native.session.request.call_args[0]
+    assert (path, method) == ("/v2/lbaas/pools/pool-id/members", "PUT")
+    assert native.session.request.call_args[1]["json"] == {
+        "members": [
+            {
+                "name": addr,
+                "address": addr,
+                "protocol_port": 6443,
+                "subnet_id": "subnet-id",
+            }
+            for addr in ("1.1.1.1", "1.1.1.2")
+        ]
+    }
+
+    cli = openstack.CLITransport()
+    with mock.patch.object(openstack, "_get_transport", return_value=cli):
+        with pytest.raises(NotImplementedError):
+            octavia.replace_members(set())
+
+
 def test_is_base64():
     cert = (
         "-----BEGIN CERTIFICATE-----\nMIIDITCCAgmgAwIBAgIUeQxHSsZt6auk1oW+"
@@ -742,6 +1823,54 @@ def test_update_credentials(_normalize_creds, _save_creds, log_err):
     status.blocked.assert_called_with("missing required credentials: region, username")
 
 
+def test_update_credentials_unchanged(_normalize_creds, _save_creds, _load_creds):
+    openstack.hookenv.config.return_value = config = {
+        "credentials": None,
+        "credentials-cache-ttl": 3600,
+    }
+    stdout = b"{}"
+    subprocess.run.side_effect = lambda *a, **k: mock.Mock(stdout=stdout)
+    _normalize_creds.return_value = {
+        "auth_url": "auth-url",
+        "region": "region",
+        "username": "username",
+        "password": "password",
+        "user_domain_name": "user-domain-name",
+        "project_domain_name": "project-domain-name",
+        "project_name": "project-name",
+        "version": "3",
+    }
+    _load_creds.return_value = _normalize_creds.return_value
+    assert openstack.update_credentials() is True
+    assert _normalize_creds.call_count == 2
+    _save_creds.assert_called_once()
+
+    # nothing is normalized again until the source of the creds changes
+    assert openstack.update_credentials() is True
+    assert _normalize_creds.call_count == 2
+    _save_creds.assert_called_once()
+
+    stdout = b'{"foo": "bar"}'
+    assert openstack.update_credentials() is True
+    assert _normalize_creds.call_count == 4
+
+    config["password"] = "changed"
+    assert openstack.update_credentials() is True
+    assert _normalize_creds.call_count == 6
+
+    openstack.clear_creds_fingerprint()
+    assert openstack.update_credentials() is True
+    assert _normalize_creds.call_count == 8
+
+    # creds whose API version couldn't be discovered are checked every hook
+    _normalize_creds.return_value["version"] = None
+    openstack.clear_creds_fingerprint()
+    assert openstack.update_credentials() is True
+    assert _normalize_creds.call_count == 10
+    assert openstack.update_credentials() is True
+    assert _normalize_creds.call_count == 12
+
+
 def test_normalize_creds(_determine_version, log_err):
     _determine_version.return_value = "3"
     with pytest.raises(ValueError) as excinfo:
@@ -832,3 +1961,35 @@ def test_normalize_creds(_determine_version, log_err):
 
     attrs["endpoint-tls-ca"] = attrs.pop("cacertificates")[0]
     assert openstack._normalize_creds(attrs) == expected
+
+
+def test_credentials_secret(_load_creds):
+    _load_creds.return_value = {
+        "auth_url": "https://keystone",
+        "password": "secret",
+        "user_domain_name": None,
+    }
+    run = openstack.subprocess.run
+    run.reset_mock()
+    run.side_effect = None
+    run.return_value.stdout = b"secret:creds\n"
+    assert openstack.credentials_secret(["clients:1"]) == "secret:creds"
+    assert [c.args[0][:3] for c in run.call_args_list] == [
+        ("secret-add", "--owner", "unit"),
+        ("secret-grant", "secret:creds", "--relation"),
+    ]
+
+    # unchanged credentials and relations don't touch the secret
+    run.reset_mock()
+    assert openstack.credentials_secret(["clients:1"]) == "secret:creds"
+    run.assert_not_called()
+
+    # rotated credentials add a revision, new relations get a grant
+    _load_creds.return_value["password"] = "rotated"
+    assert openstack.credentials_secret(["clients:1", "clients:2"]) == "secret:creds"
+    assert [c.args[0][:2] for c in run.call_args_list] == [
+        ("secret-set", "secret:creds"),
+        ("secret-grant", "secret:creds"),
+    ]
+    assert run.call_args.args[0][3] == "clients:2"
+    openstack.kv().unset(openstack.CREDS_SECRET_KEY)
@@ -4,8 +4,8 @@ import unittest.mock as mock
 import reactive.openstack as charm
 import charms.reactive
 
-from charmhelpers.core import hookenv
-from charms.layer.openstack import OpenStackError
+from charmhelpers.core import hookenv, unitdata
+from charms.layer.openstack import OpenStackError, fingerprint
 
 
 @mock.patch("reactive.openstack.endpoint_from_name")
@@ -168,6 +168,7 @@ def test_manage_loadbalancer_via_lb_consumers(
     lb_consumers.new_requests = [request]
 
     validate.side_effect = lambda req: req.response
+    hookenv.config.return_value = {"lb-concurrency": 4}
     response.error_fields = {}
     request.port_mapping = {443: 6443}
     request.backends = ["1.2.3.4"]
@@ -189,3 +190,366 @@ def test_manage_loadbalancer_via_lb_consumers(
         assert response.error is None
         assert response.error_message == ""
         lb_consumers.send_response.assert_called_once_with(request)
+
+
+@mock.patch.object(charm, "_validate_loadbalancer_request")
+@mock.patch("charms.layer.openstack.manage_loadbalancer")
+def test_manage_loadbalancer_via_lb_consumers_many(manage_loadbalancer, validate):
+    lb_consumers = charms.reactive.relations.endpoint_from_name.return_value
+    lb_consumers.send_response.reset_mock()
+    charm.layer.status.blocked.reset_mock()
+    hookenv.config.return_value = {"lb-concurrency": 2}
+    validate.side_effect = lambda req: req.response
+    requests = []
+    for i in range(5):
+        request = mock.MagicMock(name=f"req-{i}")
+        request.name = f"req-{i}"
+        request.response.error_fields = {}
+        request.port_mapping = {443: 6443}
+        request.backends = [f"1.2.3.{i}"]
+        request.algorithm = "ROUND_ROBIN"
+        requests.append(request)
+    lb_consumers.new_requests = requests
+
+    def _manage(name, members, *args):
+        if name == "req-3":
+            raise OpenStackError("failed req-3")
+        if name == "req-4":
+            raise KeyError("network_id")
+        return mock.Mock(fip=None, address=members[0][0])
+
+    manage_loadbalancer.side_effect = _manage
+    charm.manage_loadbalancers_via_lb_consumers()
+    assert manage_loadbalancer.call_count == 5
+    assert lb_consumers.send_response.call_count == 5
+    unexpected = "Error while managing load balancer; check debug-log"
+    for i, request in enumerate(requests):
+        if i == 3:
+            assert request.response.error_message == "failed req-3"
+        elif i == 4:
+            assert request.response.error_message == unexpected
+        else:
+            assert request.response.address == f"1.2.3.{i}"
+            assert request.response.error is None
+    charm.layer.status.blocked.assert_called_once()
+    assert set(charm.layer.status.blocked.call_args.args[0].split(", ")) == {
+        "failed req-3",
+        unexpected,
+    }
+
+
+@pytest.fixture
+def clients():
+    """
+    Set up handle_requests for three client units across two relations,
+    with the clients endpoint as the fixture's value.
+    """
+    with mock.patch.object(charm, "layer") as layer, mock.patch.object(
+        charm, "endpoint_from_name"
+    ) as endpoint_from_name, mock.patch.object(charm, "is_flag_set") as is_flag_set:
+        hookenv.config.return_value = {
+            "manage-security-groups": False,
+            "subnet-id": "subnet",
+            "floating-network-id": "",
+            "lb-method": "ROUND_ROBIN",
+            "lb-enabled": True,
+            "internal-lb": False,
+            "bs-version": None,
+            "clients-publish-mode": "unit",
+            "clients-credentials-secret": False,
+        }
+        hookenv.is_leader.return_value = True
+        is_flag_set.return_value = False
+        layer.openstack.fingerprint.side_effect = fingerprint
+        layer.openstack.cached_openstack_proxied.return_value = {}
+        layer.openstack.detect_octavia.return_value = True
+        layer.openstack.get_credentials.return_value = {"auth_url": "https://keystone"}
+        layer.openstack.credentials_secret.return_value = "secret:creds"
+        clients = endpoint_from_name.return_value
+        clients.layer, clients.is_flag_set = layer, is_flag_set
+        clients.relations = [
+            mock.MagicMock(relation_id=f"clients:{i}", to_publish={}, to_publish_app={})
+            for i in range(2)
+        ]
+        clients.all_requests = [
+            mock.MagicMock(unit_name=f"client/{i}") for i in range(3)
+        ]
+        clients.new_requests = clients.all_requests
+        unitdata.kv().unsetrange(prefix=charm.CLIENTS_PUBLISHED_KEY + ".")
+        yield clients
+
+
+def test_handle_requests_unchanged(clients):
+    config = hookenv.config.return_value
+    config["bs-version"] = "v3"
+    requests = clients.all_requests
+    charm.handle_requests()
+    for request in requests:
+        request.set_credentials.assert_called_once_with(auth_url="https://keystone")
+        request.set_block_storage_config.assert_called_once_with(
+            bs_version="v3", trust_device_path=None, ignore_volume_az=None
+        )
+        request.reset_mock()
+
+    # a config change which doesn't alter the data only writes new units
+    clients.is_flag_set.side_effect = lambda flag: flag == "config.changed.internal-lb"
+    clients.new_requests = requests[2:]
+    charm.handle_requests()
+    for request in requests[:2]:
+        request.set_credentials.assert_not_called()
+    requests[2].set_credentials.assert_called_once()
+    clients.layer.openstack.log.assert_called_with(
+        "Skipped {} of {} client units with unchanged data", 2, 3
+    )
+
+    # changed data is written to every unit
+    clients.new_requests = []
+    config["lb-method"] = "SOURCE_IP"
+    charm.handle_requests()
+    for request in requests:
+        request.set_lbaas_config.assert_called_with(
+            subnet_id="subnet",
+            floating_network_id="",
+            lb_method="SOURCE_IP",
+            manage_security_groups=False,
+            has_octavia=True,
+            lb_enabled=True,
+            internal_lb=False,
+        )
+    clients.mark_completed.assert_called()
+
+
+def test_handle_requests_app_data(clients):
+    config = hookenv.config.return_value
+    config["clients-publish-mode"] = "app"
+    relations, requests = clients.relations, clients.all_requests
+    charm.handle_requests()
+    for relation in relations:
+        assert relation.to_publish_app["auth_url"] == "https://keystone"
+        assert relation.to_publish_app["lb_method"] == "ROUND_ROBIN"
+        assert relation.to_publish_app["proxy_config"] == {}
+        relation.to_publish_app.clear()
+    for request in requests:
+        request.set_credentials.assert_not_called()
+    clients.mark_completed.assert_called_once_with()
+
+    # unchanged data isn't published again
+    charm.handle_requests()
+    assert relations[0].to_publish_app == {}
+
+    # the compatibility mode also writes the unit data
+    config["clients-publish-mode"] = "both"
+    config["lb-method"] = "SOURCE_IP"
+    charm.handle_requests()
+    assert relations[0].to_publish_app["lb_method"] == "SOURCE_IP"
+    for request in requests:
+        request.set_credentials.assert_called_once_with(auth_url="https://keystone")
+
+    config["clients-publish-mode"] = "invalid"
+    charm.handle_requests()
+    clients.layer.status.blocked.assert_called_once_with(
+        "Invalid value for config publish_mode='invalid'"
+    )
+
+
+def test_handle_requests_creds_secret(clients):
+    hookenv.config.return_value["clients-credentials-secret"] = True
+    layer, requests = clients.layer, clients.all_requests
+    charm.handle_requests()
+    layer.openstack.credentials_secret.assert_called_once_with(
+        ["clients:0", "clients:1"]
+    )
+    for relation in clients.relations:
+        assert relation.to_publish == {"credentials_secret_id": "secret:creds"}
+    for request in requests:
+        request.set_credentials.assert_not_called()
+        request.set_lbaas_config.assert_called_once()
+        request.reset_mock()
+
+    # rotated credentials only update the secret
+    clients.is_flag_set.side_effect = (
+        lambda flag: flag == "charm.openstack.creds.changed"
+    )
+    clients.new_requests = []
+    charm.handle_requests()
+    assert layer.openstack.credentials_secret.call_count == 2
+    for request in requests:
+        request.set_lbaas_config.assert_not_called()
+
+
+def test_handle_requests_creds_secret_enabled(clients):
+    config = hookenv.config.return_value
+    config["clients-publish-mode"] = "both"
+    relations = clients.relations
+    charm.handle_requests()
+    for relation in relations:
+        # the mocked requests don't write the unit data themselves
+        relation.to_publish["auth_url"] = "https://keystone"
+        assert relation.to_publish_app["auth_url"] == "https://keystone"
+
+    # switching to the secret removes the plain text credentials
+    config["clients-credentials-secret"] = True
+    clients.is_flag_set.side_effect = (
+        lambda flag: flag == "config.changed.clients-credentials-secret"
+    )
+    charm.handle_requests()
+    for relation in relations:
+        assert relation.to_publish == {
+            "auth_url": None,
+            "credentials_secret_id": "secret:creds",
+        }
+        assert relation.to_publish_app["auth_url"] is None
+        assert relation.to_publish_app["credentials_secret_id"] == "secret:creds"
+
+
+@mock.patch.object(charm, "is_flag_set")
+@mock.patch.object(charm, "_validate_loadbalancer_request")
+@mock.patch("charms.layer.openstack.get_unchanged_loadbalancer")
+@mock.patch("charms.layer.openstack.manage_loadbalancer")
+def test_manage_loadbalancer_via_lb_consumers_unchanged(
+    manage_loadbalancer, get_unchanged, validate, is_flag_set
+):
+    lb_consumers = charms.reactive.relations.endpoint_from_name.return_value
+    lb_consumers.send_response.reset_mock()
+    hookenv.config.return_value = {"lb-concurrency": 2}
+    is_flag_set.side_effect = lambda flag: flag == "config.changed.lb-port"
+    validate.side_effect = lambda req: req.response
+    requests = []
+    for i in range(3):
+        request = mock.MagicMock(name=f"req-{i}")
+        request.name = f"req-{i}"
+        request.response.error_fields = {}
+        request.port_mapping = {443: 6443}
+        request.backends = [f"1.2.3.{i}"]
+        request.algorithm = "ROUND_ROBIN"
+        requests.append(request)
+    lb_consumers.all_requests = requests
+    lb_consumers.new_requests = requests[2:]
+
+    # req-0 is unchanged, req-1 changed and req-2 is new
+    get_unchanged.side_effect = lambda name, *args: (
+        {"fip": None, "address": "10.0.0.1"} if name == "req-0" else None
+    )
+    manage_loadbalancer.return_value = mock.Mock(fip="8.8.8.8")
+    charm.manage_loadbalancers_via_lb_consumers()
+    assert get_unchanged.call_count == 2
+    get_unchanged.assert_any_call("req-0", [("1.2.3.0", 6443)], 443, "ROUND_ROBIN")
+    assert [c.args[0] for c in manage_loadbalancer.call_args_list] == [
+        "req-1",
+        "req-2",
+    ]
+    assert requests[0].response.address == "10.0.0.1"
+    assert requests[0].response.error is None
+    assert requests[1].response.address == "8.8.8.8"
+    assert lb_consumers.send_response.call_count == 3
+
+    # options which LBs don't depend on only get the new requests handled
+    is_flag_set.side_effect = lambda flag: flag == "config.changed.bs-version"
+    get_unchanged.reset_mock()
+    manage_loadbalancer.reset_mock()
+    charm.manage_loadbalancers_via_lb_consumers()
+    get_unchanged.assert_not_called()
+    manage_loadbalancer.assert_called_once()
+    assert manage_loadbalancer.call_args.args[0] == "req-2"
+
+
+@pytest.mark.parametrize(
+    "option, parts",
+    [
+        ("bs-version", ["clients-block-storage"]),
+        ("lb-port", ["lb-consumers", "loadbalancer"]),
+        ("lb-method", ["clients-lbaas", "lb-consumers", "loadbalancer"]),
+        ("password", ["credentials"]),
+        ("lb-wait-timeout", []),
+    ],
+)
+def test_config_dependencies(option, parts):
+    with mock.patch.object(charm, "is_flag_set") as is_flag_set:
+        is_flag_set.side_effect = lambda flag: flag == f"config.changed.{option}"
+        changed = [
+            part for part in charm.CONFIG_DEPENDENCIES if charm._config_changed(part)
+        ]
+    assert changed == parts
+
+
+@mock.patch.object(charm, "time")
+@mock.patch.object(charm, "is_flag_set")
+@mock.patch.object(charm, "endpoint_from_name")
+@mock.patch.object(charm, "layer")
+def test_manage_loadbalancers_via_loadbalancer(
+    layer, endpoint_from_name, is_flag_set, time
+):
+    hookenv.config.return_value = {
+        "lb-port": 443,
+        "lb-method": "ROUND_ROBIN",
+        "lb-drift-check-interval": 3600,
+    }
+    charm.unitdata.kv().unset(charm.LB_DRIFT_CHECKED_KEY)
+    is_flag_set.return_value = False
+    time.return_value = 10000
+    request = mock.MagicMock(application_name="app", members=[("1.2.3.4", 80)])
+    request.algorithm = None
+    endpoint_from_name.return_value.requests = [request]
+    manage_loadbalancer = layer.openstack.manage_loadbalancer
+    manage_loadbalancer.return_value = mock.Mock(fip="8.8.8.8", port="443")
+
+    # the first hook checks for drift
+    charm.manage_loadbalancers_via_loadbalancer()
+    layer.openstack.get_unchanged_loadbalancer.assert_not_called()
+    manage_loadbalancer.assert_called_once_with(
+        "app", [("1.2.3.4", 80)], "443", "ROUND_ROBIN", "loadbalancer", refresh=True
+    )
+    request.set_address_port.assert_called_once_with("8.8.8.8", "443")
+
+    # unchanged requests make no API calls until the next drift check
+    manage_loadbalancer.reset_mock()
+    layer.status.maintenance.reset_mock()
+    layer.openstack.get_unchanged_loadbalancer.return_value = {
+        "fip": None,
+        "address": "10.0.0.1",
+        "port": "443",
+    }
+    time.return_value = 13000
+    charm.manage_loadbalancers_via_loadbalancer()
+    manage_loadbalancer.assert_not_called()
+    layer.openstack.get_unchanged_loadbalancer.assert_called_once_with(
+        "app", [("1.2.3.4", 80)], "443", "ROUND_ROBIN"
+    )
+    request.set_address_port.assert_called_with("10.0.0.1", "443")
+    layer.status.maintenance.assert_not_called()
+
+    # changed requests are managed
+    layer.openstack.get_unchanged_loadbalancer.return_value = None
+    charm.manage_loadbalancers_via_loadbalancer()
+    manage_loadbalancer.assert_called_once()
+    assert manage_loadbalancer.call_args.kwargs["refresh"] is False
+
+    # as is everything once a drift check is due, or the config changed
+    manage_loadbalancer.reset_mock()
+    layer.openstack.get_unchanged_loadbalancer.reset_mock()
+    layer.openstack.get_unchanged_loadbalancer.return_value = {"port": "443"}
+    time.return_value = 13600
+    charm.manage_loadbalancers_via_loadbalancer()
+    manage_loadbalancer.assert_called_once()
+    assert manage_loadbalancer.call_args.kwargs["refresh"] is True
+    layer.openstack.get_unchanged_loadbalancer.assert_not_called()
+    time.return_value = 13700
+    is_flag_set.side_effect = lambda flag: flag == "config.changed.lb-subnet"
+    charm.manage_loadbalancers_via_loadbalancer()
+    assert manage_loadbalancer.call_count == 2
+    charm.unitdata.kv().unset(charm.LB_DRIFT_CHECKED_KEY)
+
+
+@mock.patch.object(charm, "layer")
+def test_cleanup(layer):
+    hookenv.config.return_value = {"lb-concurrency": 4, "lb-teardown-timeout": 300}
+    hookenv.log.reset_mock()
+    layer.openstack.get_all_cached_lbs.return_value = {"created_lbs.a": {"a": 1}}
+    layer.openstack.delete_loadbalancers.return_value = (["a", "b"], ["c"], [])
+    charm.cleanup()
+    args = layer.openstack.delete_loadbalancers.call_args.args
+    assert list(args[0]) == [{"a": 1}]
+    assert args[1:] == (4, 300)
+    hookenv.log.assert_called_once_with(
+        "Deleted 2 load balancers; still pending: c; failed: none", hookenv.WARNING
+    )